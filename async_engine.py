@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterparts of the media server clients and the webhook
+dispatcher, used by the "async" engine.
+
+Every request of a run goes through one aiohttp session, so library
+queries, show lookups and webhook sends for all servers and webhooks
+overlap on a single event loop instead of needing a thread each. The
+queries and the records they produce are the same as in sources.py.
+"""
+import asyncio
+import json
+import xml.etree.ElementTree as ElementTree
+from datetime import timezone
+from urllib.parse import urlencode, urlsplit
+from dispatcher import RateLimits
+from sources import JellyfinClient, JellyfinSource, PlexSource, metadata_batch_size, page_size, parse_jellyfin_date
+from transport import RETRY_STATUSES
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+# Methods that are retried, as urllib3 does by default. A webhook POST may
+# have been delivered even though its response was lost, so it is retried
+# by the outbox instead.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE")
+
+
+def query_string(params):
+    """urlencode, writing booleans the way requests does and leaving out None"""
+    return urlencode({key: str(value) if isinstance(value, bool) else value
+                      for key, value in params.items() if value is not None})
+
+
+class AsyncHTTP:
+    """
+    Thin wrapper around an aiohttp session that retries 5xx responses and
+    connection errors of idempotent requests with exponential backoff, and counts requests and
+    bytes like transport.py's session does.
+
+    Arguments:
+    session -- aiohttp.ClientSession
+    options -- the http settings (see transport.DEFAULT_OPTIONS)
+    metrics -- optional Metrics to count requests in
+    """
+
+    def __init__(self, session, options, metrics=None):
+        self.session = session
+        self.options = options
+        self.metrics = metrics
+
+    @classmethod
+    def create_session(cls, options):
+        """Creates a pooled aiohttp session with the configured timeouts"""
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=options["pool_size"]),
+            timeout=aiohttp.ClientTimeout(sock_connect=options["connect_timeout"],
+                                          sock_read=options["read_timeout"]))
+
+    async def request(self, method, url, params=None, **kwargs):
+        """
+        Sends a request and returns (status, headers, body). The URL is
+        used as given, so callers can keep characters such as ">>" in it.
+        """
+        if params:
+            url += ("&" if "?" in url else "?") + query_string(params)
+        retries = self.options["retries"] if method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                async with self.session.request(method, URL(url, encoded=True), **kwargs) as response:
+                    body = await response.read()
+                    self._count(url, response.status, kwargs.get("data"), body)
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        return response.status, response.headers, body
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(self.options["backoff_factor"] * 2 ** attempt)
+
+    def _count(self, url, status, sent, body):
+        if self.metrics is None:
+            return
+        host = urlsplit(url).netloc
+        self.metrics.inc("http_requests_total", host=host, status=str(status))
+        self.metrics.inc("http_request_bytes_total", len(sent) if sent else 0, host=host)
+        self.metrics.inc("http_response_bytes_total", len(body), host=host)
+
+
+async def resolve_library(registry, library, lock, load):
+    """
+    LibraryRegistry.resolve for the async clients: returns the cached
+    (key, media_type) of a library, or lists the server's libraries with
+    load, a coroutine function, if it is neither cached nor known to be
+    missing.
+    """
+    entry = registry.get(library)
+    if entry is not None or registry.is_missing(library):
+        return entry
+    async with lock:
+        entry = registry.get(library)
+        if entry is None and not registry.is_missing(library):
+            registry.update(await load())
+            entry = registry.get(library)
+            if entry is None:
+                registry.mark_missing(library)
+    return entry
+
+
+class AsyncPlex:
+    """Reads a PlexSource's server over AsyncHTTP"""
+
+    def __init__(self, source, http):
+        self.source = source
+        self.http = http
+        self.url = source.url.rstrip("/")
+        self.headers = {"X-Plex-Token": source.token, "Accept": "application/xml"}
+        self.libraries_lock = asyncio.Lock()
+
+    async def query(self, key, params=None):
+        status, _, body = await self.http.request("GET", self.url + key, params, headers=self.headers)
+        if status == 404:
+            # Most likely a section that was removed, or recreated under a new key
+            self.source.libraries.invalidate()
+        if status != 200:
+            raise Exception(f"Plex request failed: {status}")
+        return ElementTree.fromstring(body) if body.strip() else None
+
+    async def list_libraries(self):
+        return PlexSource.library_entries(await self.query("/library/sections"))
+
+    async def library(self, library):
+        entry = await resolve_library(self.source.libraries, library, self.libraries_lock,
+                                      self.list_libraries)
+        if entry is None:
+            raise Exception(f"Invalid library section: {library}")
+        return entry
+
+    async def recent_items(self, library, media_type, since):
+        """Yields the library's RecentItems added after since, fetching a page at a time"""
+        section_key, _ = await self.library(library)
+        key, params = PlexSource.recent_query(section_key, media_type, since)
+        while True:
+            container = await self.query(key, params)
+            elements = list(container) if container is not None else []
+            for element in elements:
+                yield PlexSource._element_item(element)
+            if len(elements) < page_size:
+                return
+            params['X-Plex-Container-Start'] += page_size
+
+    async def show_titles(self, show_ids):
+        async def batch(keys):
+            container = await self.query("/library/metadata/" + ",".join(str(key) for key in keys))
+            return [PlexSource._item(element.attrib) for element in container]
+
+        shows = {}
+        for batch_shows in await asyncio.gather(*(
+                batch(show_ids[i:i + metadata_batch_size])
+                for i in range(0, len(show_ids), metadata_batch_size))):
+            shows.update((show.item_id, (show.title, show.year)) for show in batch_shows)
+        return shows
+
+
+class AsyncJellyfin:
+    """Reads a JellyfinSource's server over AsyncHTTP"""
+
+    def __init__(self, source, http):
+        self.source = source
+        self.http = http
+        self.url = source.client.url
+        self.headers = source.client.headers
+        self.libraries_lock = asyncio.Lock()
+
+    async def get(self, path, params=None):
+        status, _, body = await self.http.request("GET", self.url + path, params, headers=self.headers)
+        if status != 200:
+            raise Exception(f"Jellyfin request failed: {status}")
+        return json.loads(body)
+
+    async def list_libraries(self):
+        return JellyfinSource.library_entries(await self.get("/Library/VirtualFolders"))
+
+    async def library(self, library):
+        entry = await resolve_library(self.source.libraries, library, self.libraries_lock,
+                                      self.list_libraries)
+        return entry or (library, None)
+
+    async def recent_items(self, library, media_type, since):
+        """Yields the library's RecentItems added after since, fetching a page at a time"""
+        since = since.astimezone(timezone.utc)
+        library_id, _ = await self.library(library)
+        params = JellyfinClient.library_items_params(library_id, JellyfinSource.item_types[media_type], since)
+        threshold = since.timestamp()
+        while True:
+            page = (await self.get("/Users/Items", params)).get('Items', [])
+            for item in page:
+                if parse_jellyfin_date(item['DateCreated']) <= threshold:
+                    return
+                yield JellyfinSource._item(item)
+            if len(page) < page_size:
+                return
+            params['StartIndex'] += page_size
+
+    async def show_titles(self, show_ids):
+        async def batch(ids):
+            params = {'Ids': ",".join(ids), 'EnableImages': False, 'EnableUserData': False}
+            return (await self.get("/Items", params)).get('Items', [])
+
+        shows = {}
+        for batch_shows in await asyncio.gather(*(
+                batch(show_ids[i:i + metadata_batch_size])
+                for i in range(0, len(show_ids), metadata_batch_size))):
+            shows.update((series['Id'], (series.get('Name', 'Unknown'), series.get('ProductionYear')))
+                         for series in batch_shows)
+        return shows
+
+
+# Async clients by MediaSource platform
+ASYNC_CLIENTS = {
+    "plex": AsyncPlex,
+    "jellyfin": AsyncJellyfin
+}
+
+
+class WebhookError(Exception):
+    """A webhook answered with an error other than a rate limit"""
+
+    def __init__(self, status, message):
+        super().__init__(f"Webhook returned {status}: {message}")
+        self.status = status
+
+
+class AsyncWebhookDispatcher(RateLimits):
+    """
+    asyncio version of WebhookDispatcher: waits for each webhook's rate
+    limit bucket and retries when rate limited. One dispatcher is kept for
+    the whole process, so the buckets carry over from one delivery to the
+    next; the AsyncHTTP to send with is passed to each send.
+    """
+
+    def __init__(self, max_attempts=5):
+        super().__init__(max_attempts)
+        self.locks = {}
+
+    async def send(self, http, url, content="", embeds=None):
+        """
+        Posts a message to a Discord webhook. Raises if it could not be
+        delivered.
+
+        Arguments:
+        http -- the AsyncHTTP to send with
+        url -- the webhook URL
+        content -- message text
+        embeds -- list of embed dicts
+        """
+        data = json.dumps({"content": content, "embeds": embeds or []}).encode()
+        bucket = self._bucket(url)
+        async with self.locks.setdefault(url, asyncio.Lock()):
+            for attempt in range(self.max_attempts):
+                await asyncio.sleep(self.delay(bucket))
+
+                # wait=true makes Discord confirm the message was created
+                status, headers, body = await http.request(
+                    "POST", url, {"wait": "true"}, data=data,
+                    headers={"Content-Type": "application/json"})
+                bucket.update(headers)
+                if status != 429:
+                    if status >= 400:
+                        raise WebhookError(status, body.decode(errors="replace")[:200])
+                    return
+                self.rate_limited(bucket, headers, body)
+
+        raise Exception(f"Still rate limited after {self.max_attempts} attempts")
+
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Benchmarks run_update() against local stand-ins for Plex, Jellyfin and a
+Discord webhook.
+
+Each scenario generates a library (movies, shows and episodes, some of them
+recently added), serves it from a fake media server and runs main.py's
+update in a fresh process, once cold and then again with the run state and
+show cache left by the previous run. For every run it reports the requests
+issued (per endpoint), the bytes transferred, the wall time and the peak
+RSS, so N+1 query patterns show up as request counts that grow with the
+library.
+
+    python benchmark.py
+    python benchmark.py --scenario bulk_import --platform plex --latency 20
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import quoteattr
+
+import yaml
+
+# Library sizes: total movies and episodes, the number of shows the
+# episodes belong to, and how many of each were added within the lookback
+SCENARIOS = {
+    "small": {
+        "movies": 500, "shows": 50, "episodes": 2000,
+        "new_movies": 5, "new_episodes": 20, "new_shows": 3
+    },
+    "large": {
+        "movies": 10000, "shows": 1000, "episodes": 50000,
+        "new_movies": 25, "new_episodes": 300, "new_shows": 10
+    },
+    "bulk_import": {
+        "movies": 10000, "shows": 1000, "episodes": 50000,
+        "new_movies": 1000, "new_episodes": 5000, "new_shows": 200
+    },
+    "quiet": {
+        "movies": 10000, "shows": 1000, "episodes": 50000,
+        "new_movies": 0, "new_episodes": 0, "new_shows": 0
+    }
+}
+
+LOOKBACK_PERIOD = "4h"
+
+# Run inside the child process, from the working directory with config.yml
+CHILD_SCRIPT = """
+import asyncio, json, resource, time
+from datetime import datetime
+import main
+start = time.perf_counter()
+if main.engine == "async":
+    asyncio.run(main.run_update_async(until=datetime.now()))
+else:
+    main.run_update(until=datetime.now())
+print(json.dumps({
+    "wall_time": time.perf_counter() - start,
+    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+}))
+"""
+
+
+def generate_library(scenario, seed=0):
+    """
+    Builds the movies, shows and episodes of a scenario as plain dicts,
+    newest first. Recently added media falls within the last hour; the rest
+    was added between a day and a year ago.
+
+    Arguments:
+    scenario -- dict of library sizes from SCENARIOS
+    seed -- random seed, so every run serves the same library
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+
+    def added_at(is_new):
+        return now - rng.randint(0, 3600) if is_new else now - rng.randint(86400, 365 * 86400)
+
+    movies = [{
+        "id": 1 + i,
+        "title": f"Movie {i}",
+        "year": rng.randint(1950, 2025),
+        "added_at": added_at(i < scenario["new_movies"])
+    } for i in range(scenario["movies"])]
+
+    shows = [{
+        "id": 100000 + i,
+        "title": f"Show {i}",
+        "year": rng.randint(1990, 2025)
+    } for i in range(scenario["shows"])]
+
+    # New episodes are whole runs of a season, like a season pack, spread
+    # over the first new_shows shows
+    episodes = []
+    for i in range(scenario["episodes"]):
+        is_new = i < scenario["new_episodes"]
+        if is_new:
+            show = shows[i % max(scenario["new_shows"], 1)]
+            number = i // max(scenario["new_shows"], 1)
+            season, episode = 1 + number // 10, 1 + number % 10
+        else:
+            show = shows[rng.randrange(len(shows))]
+            season, episode = rng.randint(1, 10), rng.randint(1, 24)
+        episodes.append({
+            "id": 200000 + i,
+            "title": f"Episode {i}",
+            "show": show,
+            "season": season,
+            "episode": episode,
+            "added_at": added_at(is_new)
+        })
+
+    movies.sort(key=lambda item: item["added_at"], reverse=True)
+    episodes.sort(key=lambda item: item["added_at"], reverse=True)
+    return {"movies": movies, "shows": {show["id"]: show for show in shows}, "episodes": episodes}
+
+
+def jellyfin_date(timestamp):
+    """Format epoch seconds the way Jellyfin does, with seven fractional digits"""
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+class FakeServer:
+    """
+    HTTP server that answers like a Plex or Jellyfin server and a Discord
+    webhook, and counts the requests and bytes it handles per endpoint.
+    """
+
+    def __init__(self, platform, library, latency=0.0):
+        self.platform = platform
+        self.library = library
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+        handler = type("Handler", (FakeHandler,), {"fake": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def record(self, endpoint, bytes_in, bytes_out):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def plex(self, path, query):
+        """Returns the XML for a Plex request"""
+        if path == "/":
+            return '<MediaContainer machineIdentifier="benchmark" version="1.40.0"/>'
+        if path == "/library":
+            return '<MediaContainer identifier="com.plexapp.plugins.library"/>'
+        if path == "/library/sections":
+            return ('<MediaContainer>'
+                    '<Directory key="1" type="movie" title="Movies"/>'
+                    '<Directory key="2" type="show" title="TV"/>'
+                    '</MediaContainer>')
+
+        match = re.fullmatch(r"/library/sections/(\d+)/all", path)
+        if match:
+            items = self.library["movies"] if query.get("type") == ["1"] else self.library["episodes"]
+            since = int(query.get("addedAt>>", ["0"])[0])
+            until = int(query.get("addedAt<<", [str(2 ** 32)])[0])
+            start = int(query.get("X-Plex-Container-Start", ["0"])[0])
+            size = int(query.get("X-Plex-Container-Size", ["50"])[0])
+            page = [item for item in items if since <= item["added_at"] <= until][start:start + size]
+            return f'<MediaContainer size="{len(page)}">{"".join(self.plex_item(item) for item in page)}</MediaContainer>'
+
+        match = re.fullmatch(r"/library/metadata/([\d,]+)", path)
+        if match:
+            shows = [self.library["shows"][int(key)] for key in match.group(1).split(",")
+                     if int(key) in self.library["shows"]]
+            return "<MediaContainer>" + "".join(
+                f'<Directory ratingKey="{show["id"]}" type="show" title={quoteattr(show["title"])}'
+                f' year="{show["year"]}"/>' for show in shows) + "</MediaContainer>"
+        return None
+
+    @staticmethod
+    def plex_item(item):
+        if "show" not in item:
+            return (f'<Video ratingKey="{item["id"]}" type="movie" title={quoteattr(item["title"])}'
+                    f' year="{item["year"]}" addedAt="{item["added_at"]}" summary="A movie."/>')
+        show = item["show"]
+        return (f'<Video ratingKey="{item["id"]}" type="episode" title={quoteattr(item["title"])}'
+                f' grandparentRatingKey="{show["id"]}" grandparentTitle={quoteattr(show["title"])}'
+                f' parentIndex="{item["season"]}" index="{item["episode"]}"'
+                f' addedAt="{item["added_at"]}" summary="An episode."/>')
+
+    def jellyfin(self, path, query):
+        """Returns the JSON for a Jellyfin request"""
+        if path == "/Users/Items":
+            items = self.library["movies"] if query.get("ParentId") == ["movies"] else self.library["episodes"]
+            if "MinDateLastSaved" in query:
+                since = datetime.strptime(query["MinDateLastSaved"][0], "%Y-%m-%dT%H:%M:%SZ")
+                since = (since - datetime(1970, 1, 1)).total_seconds()
+                items = [item for item in items if item["added_at"] >= since]
+            if query.get("SortOrder") == ["Ascending"]:
+                items = items[::-1]
+            if "Ids" in query:
+                ids = set(query["Ids"][0].split(","))
+                items = [item for item in items if str(item["id"]) in ids]
+            start = int(query.get("StartIndex", ["0"])[0])
+            limit = int(query.get("Limit", [str(len(items))])[0])
+            return json.dumps({"Items": [self.jellyfin_item(item) for item in items[start:start + limit]]})
+
+        if path == "/Library/VirtualFolders":
+            return json.dumps([
+                {"Name": "Movies", "ItemId": "movies", "CollectionType": "movies"},
+                {"Name": "TV", "ItemId": "tv", "CollectionType": "tvshows"}
+            ])
+
+        if path == "/Items":
+            ids = query.get("Ids", [""])[0].split(",")
+            shows = [self.library["shows"][int(key)] for key in ids
+                     if key.isdigit() and int(key) in self.library["shows"]]
+            return json.dumps({"Items": [{
+                "Id": str(show["id"]), "Name": show["title"], "ProductionYear": show["year"]
+            } for show in shows]})
+        return None
+
+    @staticmethod
+    def jellyfin_item(item):
+        result = {
+            "Id": str(item["id"]),
+            "Name": item["title"],
+            "DateCreated": jellyfin_date(item["added_at"])
+        }
+        if "show" in item:
+            result.update({
+                "SeriesId": str(item["show"]["id"]),
+                "SeriesName": item["show"]["title"],
+                "ParentIndexNumber": item["season"],
+                "IndexNumber": item["episode"]
+            })
+        else:
+            result["ProductionYear"] = item["year"]
+        return result
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set on the subclass created by FakeServer
+    fake = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if self.fake.platform == "plex":
+            body, content_type = self.fake.plex(url.path, query), "text/xml"
+        else:
+            body, content_type = self.fake.jellyfin(url.path, query), "application/json"
+        self.respond(url.path, 0, body, content_type)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = json.dumps({"id": "1"}) if url.path.startswith("/webhooks/") else None
+        self.respond(url.path, length, body, "application/json",
+                     {"X-RateLimit-Remaining": "5", "X-RateLimit-Reset-After": "1"})
+
+    def respond(self, path, bytes_in, body, content_type, headers=None):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        data = body.encode() if body is not None else b""
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+        # IDs are folded together so every kind of request is counted once
+        endpoint = f"{self.command} {re.sub(r'[0-9][0-9,]*', '{id}', path)}"
+        self.fake.record(endpoint, bytes_in, len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_config(workdir, platform, server_url, engine="threads"):
+    """Writes a config.yml for the fake server into the working directory"""
+    if platform == "plex":
+        server = {"url": server_url, "token": "benchmark",
+                  "libraries": {"movies": "Movies", "shows": "TV"}}
+    else:
+        server = {"url": server_url, "api_key": "benchmark",
+                  "libraries": {"movies": "Movies", "shows": "TV"}}
+    config = {
+        "engine": engine,
+        "platform": platform,
+        platform: server,
+        "data_dir": str(workdir / "data"),
+        f"{platform}_discord_media_updates": {
+            "webhook": f"{server_url}/webhooks/benchmark/token",
+            "lookback_period": LOOKBACK_PERIOD,
+            "skip_libraries": {"movies": False, "shows": False},
+            "max_concurrency": 4,
+            "show_total_episode_count": True,
+            "show_episode_count_per_show": True,
+            "show_episode_numbers": True,
+            "message_options": {"titles": {"standard": "Recently Added in the last"}},
+            "embed_options": {
+                "thumbnail": "",
+                "bullet": "•",
+                "movies_colour": 0xFB8800,
+                "shows_colour": 0xDE4501,
+                "movies_emote": ":clapper:",
+                "shows_emote": ":tv:"
+            },
+            "library_groups": {"standard": {"libraries": ["movies", "shows"]}}
+        }
+    }
+    with open(workdir / "config.yml", "w", encoding="utf-8") as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+
+
+def run_scenario(name, platform, runs, latency, engine="threads", verbose=False):
+    """
+    Runs one scenario against one platform and returns a list of results,
+    one per run.
+
+    Arguments:
+    name -- key of the scenario in SCENARIOS
+    platform -- "plex" or "jellyfin"
+    runs -- number of consecutive runs; the first starts without state
+    latency -- seconds the fake server waits before every response
+    engine -- "threads" or "async"
+    verbose -- show the app's log output
+    """
+    fake = FakeServer(platform, generate_library(SCENARIOS[name]), latency)
+    workdir = Path(tempfile.mkdtemp(prefix="recentlyadded-benchmark-"))
+    results = []
+    try:
+        for path in Path(__file__).parent.glob("*.py"):
+            if path.name != Path(__file__).name:
+                shutil.copy(path, workdir)
+        (workdir / "logs").mkdir()
+        write_config(workdir, platform, fake.url, engine)
+
+        for run in range(1, runs + 1):
+            fake.reset()
+            child = subprocess.run(
+                [sys.executable, "-c", CHILD_SCRIPT], cwd=workdir,
+                env=dict(os.environ, LOG_DIR=str(workdir / "logs")),
+                stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL,
+                universal_newlines=True)
+            if child.returncode != 0:
+                raise Exception(f"{name}/{platform} run {run} failed with exit code {child.returncode}")
+            measured = json.loads(child.stdout.strip().splitlines()[-1])
+            results.append({
+                "scenario": name,
+                "platform": platform,
+                "engine": engine,
+                "run": run,
+                "requests": sum(fake.requests.values()),
+                "endpoints": dict(sorted(fake.requests.items())),
+                "bytes_in": fake.bytes_in,
+                "bytes_out": fake.bytes_out,
+                "wall_time": round(measured["wall_time"], 3),
+                "peak_rss_mb": round(measured["peak_rss_kb"] / 1024, 1)
+            })
+    finally:
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print(f"{'scenario':<12} {'platform':<9} {'engine':<8} {'run':>3} {'requests':>8} {'wall s':>7}"
+          f" {'rss MB':>7} {'sent KB':>8} {'recv KB':>8}")
+    for result in results:
+        print(f"{result['scenario']:<12} {result['platform']:<9} {result['engine']:<8} {result['run']:>3}"
+              f" {result['requests']:>8} {result['wall_time']:>7.2f} {result['peak_rss_mb']:>7.1f}"
+              f" {result['bytes_in'] / 1024:>8.1f} {result['bytes_out'] / 1024:>8.1f}")
+        for endpoint, count in result["endpoints"].items():
+            print(f"    {count:>6}  {endpoint}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--platform", action="append", choices=["plex", "jellyfin"],
+                        help="media server to emulate (repeatable; default: both)")
+    parser.add_argument("--engine", action="append", choices=["threads", "async"],
+                        help="engine to run (repeatable; default: threads)")
+    parser.add_argument("--runs", type=int, default=2,
+                        help="consecutive runs per scenario (default: 2)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="milliseconds added to every fake server response")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the app's log output")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        for platform in args.platform or ["plex", "jellyfin"]:
+            for engine in args.engine or ["threads"]:
+                results.extend(run_scenario(name, platform, args.runs, args.latency / 1000,
+                                            engine, args.verbose))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded cache for show metadata.
+
+Show titles and years almost never change, yet every run and every
+library holding the same series (e.g. "TV" and "TV - 4K") would otherwise
+look them up again. Entries expire after a TTL, the least recently used
+entries are evicted once the cache is full, and the cache can be saved to
+disk so a restart starts warm.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from storage import atomic_write_json
+
+
+class MetadataCache:
+    def __init__(self, max_entries, ttl, path=None):
+        """
+        Arguments:
+        max_entries -- number of entries kept before the oldest are evicted
+        ttl -- seconds an entry stays valid
+        path -- optional JSON file the cache is loaded from and saved to
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, stored_at), least recently used first
+        self.entries = OrderedDict()
+        if self.path:
+            self._load()
+
+    def _load(self):
+        """Read the cache file, skipping expired entries"""
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                entries = json.load(file).get("entries", [])
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, value, stored_at in entries[-self.max_entries:]:
+            if now - stored_at < self.ttl:
+                self.entries[key] = (tuple(value), stored_at)
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def take_stats(self):
+        """Return (hits, misses) since the last call and reset the counters"""
+        with self.lock:
+            stats = (self.hits, self.misses)
+            self.hits = self.misses = 0
+            return stats
+
+    def save(self):
+        """Atomically write the cache file, if persistence is enabled"""
+        if not self.path:
+            return
+        def snapshot():
+            with self.lock:
+                return {"entries": [[key, list(value), stored_at]
+                                    for key, (value, stored_at) in self.entries.items()]}
+
+        atomic_write_json(self.path, snapshot)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Rate-limit-aware sending of Discord webhook messages.
+
+Discord reports each webhook's rate limit bucket in the X-RateLimit-*
+headers of every response, and answers with 429 and a retry delay once a
+bucket (or the global limit) is exhausted. The dispatcher tracks those
+buckets, holds sends to the same webhook in line and paces them so the
+bucket is not overrun. A 429 is waited out and retried instead of losing
+the message.
+"""
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Bucket:
+    """Rate limit state of a single webhook"""
+
+    def __init__(self):
+        # Held while a message is being sent, so sends to the same webhook
+        # queue up behind each other
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, headers):
+        """Record the limits reported in a response's headers"""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = time.monotonic() + float(reset_after)
+
+    def delay(self):
+        """Seconds to wait before the bucket allows another request"""
+        if self.remaining == 0:
+            return max(0.0, self.reset_at - time.monotonic())
+        return 0.0
+
+    def hold(self, seconds):
+        """Allow no requests for the given number of seconds"""
+        self.remaining = 0
+        self.reset_at = time.monotonic() + seconds
+
+
+class RateLimits:
+    """
+    The buckets of every webhook and Discord's global limit. The thread and
+    asyncio dispatchers share this bookkeeping and only differ in how they
+    wait and send.
+    """
+
+    def __init__(self, max_attempts=5):
+        self.max_attempts = max_attempts
+        self.buckets = {}
+        self.global_reset_at = 0.0
+        self.lock = threading.Lock()
+
+    def _bucket(self, url):
+        with self.lock:
+            return self.buckets.setdefault(url, Bucket())
+
+    def delay(self, bucket):
+        """Seconds to wait before sending to the bucket's webhook"""
+        return max(bucket.delay(), self.global_reset_at - time.monotonic(), 0.0)
+
+    def rate_limited(self, bucket, headers, body):
+        """
+        Records a 429 response, holding the bucket or every webhook for as
+        long as Discord asked us to wait.
+
+        Arguments:
+        bucket -- Bucket of the webhook that was rate limited
+        headers -- the response headers
+        body -- the response body, as bytes
+        """
+        try:
+            retry_after = float(json.loads(body)["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            retry_after = float(headers.get("Retry-After", 1))
+        if headers.get("X-RateLimit-Global"):
+            self.global_reset_at = time.monotonic() + retry_after
+        else:
+            bucket.hold(retry_after)
+        logger.warning(f"Rate limited by Discord, retrying in {retry_after:.1f}s")
+
+
+class WebhookDispatcher(RateLimits):
+    def __init__(self, session, max_attempts=5):
+        super().__init__(max_attempts)
+        self.session = session
+
+    def send(self, url, content="", embeds=None):
+        """
+        Posts a message to a Discord webhook, waiting for its rate limit
+        bucket and retrying when rate limited. Returns the response, or
+        raises if the message could not be delivered.
+
+        Arguments:
+        url -- the webhook URL
+        content -- message text
+        embeds -- list of embed dicts (e.g. from dhooks' Embed.to_dict())
+        """
+        payload = {
+            "content": content,
+            "embeds": embeds or []
+        }
+        bucket = self._bucket(url)
+        with bucket.lock:
+            for attempt in range(self.max_attempts):
+                time.sleep(self.delay(bucket))
+
+                # wait=true makes Discord confirm the message was created
+                response = self.session.post(url, json=payload, params={"wait": "true"})
+                bucket.update(response.headers)
+                if response.status_code != 429:
+                    response.raise_for_status()
+                    return response
+                self.rate_limited(bucket, response.headers, response.content)
+
+        raise Exception(f"Still rate limited after {self.max_attempts} attempts")
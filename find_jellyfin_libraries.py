@@ -1,22 +1,23 @@
 #!/usr/bin/env python3
 """
-Helper script to find Jellyfin library IDs for configuration.
-Run this script to get the library IDs you need for the config.yml file.
+Helper script to find Jellyfin library names and IDs for configuration.
+Either can be used in the libraries section of the config.yml file.
 """
 
-import requests
 import yaml
 from pathlib import Path
+from transport import create_session
 
-def get_jellyfin_libraries(url, api_key):
+def get_jellyfin_libraries(url, api_key, session=None):
     """Get all libraries from Jellyfin"""
+    session = session or create_session()
     headers = {
         'X-Emby-Token': api_key,
         'Content-Type': 'application/json'
     }
     
-    # Get all libraries
-    response = requests.get(f"{url}/Users/Items", headers=headers)
+    # Get all libraries ("virtual folders")
+    response = session.get(f"{url}/Library/VirtualFolders", headers=headers)
     if response.status_code == 200:
         return response.json()
     else:
@@ -41,8 +42,8 @@ def main():
         print("\nFound Libraries:")
         print("-" * 30)
         
-        for item in libraries_data.get('Items', []):
-            item_id = item.get('Id')
+        for item in libraries_data:
+            item_id = item.get('ItemId')
             name = item.get('Name', 'Unknown')
             item_type = item.get('CollectionType', 'Unknown')
             
@@ -51,7 +52,7 @@ def main():
             print(f"Type: {item_type}")
             print("-" * 30)
         
-        print("\nCopy these IDs to your config.yml file in the libraries section.")
+        print("\nCopy these names or IDs to your config.yml file in the libraries section.")
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Local history of announced media.
+
+Every announced movie and episode is recorded in a SQLite database, with
+its title normalized so the same movie in several libraries is grouped
+together. Daily, weekly and monthly rollups are then built with SQL
+aggregation over the history instead of querying the media server again,
+and the database doubles as a queryable record of what was posted.
+"""
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS announced (
+    job TEXT NOT NULL,
+    library TEXT NOT NULL,
+    category TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    title_key TEXT NOT NULL,
+    year INTEGER,
+    show TEXT,
+    show_key TEXT,
+    show_year INTEGER,
+    season INTEGER,
+    episode INTEGER,
+    added_at INTEGER,
+    announced_at INTEGER NOT NULL,
+    PRIMARY KEY (job, library, item_id)
+);
+DROP INDEX IF EXISTS announced_by_time;
+CREATE INDEX IF NOT EXISTS announced_by_added ON announced (job, media_type, added_at);
+CREATE INDEX IF NOT EXISTS announced_by_title ON announced (title_key, year);
+CREATE INDEX IF NOT EXISTS announced_by_show ON announced (show_key, season, episode);
+CREATE TEMP TABLE pending (
+    batch INTEGER NOT NULL,
+    job TEXT NOT NULL,
+    library TEXT NOT NULL,
+    category TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    year INTEGER,
+    show_id TEXT,
+    show TEXT,
+    show_year INTEGER,
+    season INTEGER,
+    episode INTEGER,
+    added_at INTEGER
+);
+CREATE INDEX temp.pending_by_show ON pending (batch, show_id);
+"""
+
+# Staged rows are written to SQLite in batches of this many
+stage_batch_size = 500
+
+
+def normalize_title(title):
+    """
+    Returns the key a title is grouped by: case folded, with punctuation
+    and runs of spaces collapsed, so "Spider-Man: No Way Home" and
+    "Spider-Man No Way Home" match.
+    """
+    if title is None:
+        return None
+    return re.sub(r"\W+", " ", title.casefold()).strip()
+
+
+class History:
+    def __init__(self, path):
+        """
+        Arguments:
+        path -- SQLite database file, created if it is missing
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.next_batch = 1
+        # Shared by the worker threads, so every use is under the lock.
+        # Items waiting to be announced are staged in a temporary table,
+        # which goes away with the connection.
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.create_function("normalize_title", 1, normalize_title)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def begin(self, job, library, category):
+        """
+        Returns a PendingBatch to stage the items of one library's digest
+        in until it is queued.
+
+        Arguments:
+        job -- name of the job that announces the items
+        library -- name of the library the items were added to
+        category -- key of the library in the job's library categories
+        """
+        with self.lock:
+            batch = self.next_batch
+            self.next_batch += 1
+        return PendingBatch(self, batch, job, library, category)
+
+    def movies(self, job, start, end):
+        """
+        Returns the movies a job announced that were added between start
+        and end (epoch seconds), one row per title and year however many libraries they
+        were added to: (title, year, categories) tuples sorted by title,
+        where categories is the set of library categories.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT MIN(title), year, GROUP_CONCAT(DISTINCT category) FROM announced"
+                " WHERE job = ? AND media_type = 'movie' AND added_at >= ? AND added_at < ?"
+                " GROUP BY title_key, year ORDER BY title_key, year",
+                (job, int(start), int(end))).fetchall()
+        return [(title, year, set(categories.split(","))) for title, year, categories in rows]
+
+    def shows(self, job, start, end):
+        """
+        Returns the shows whose episodes a job announced were added between
+        start and end (epoch seconds): (title, year, episode_count, seasons,
+        categories) tuples sorted by title. An episode added to several
+        libraries is counted once, and seasons maps each season number to
+        the set of its episode numbers.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT MIN(show), show_year,"
+                " COUNT(DISTINCT COALESCE(season || 'x' || episode, library || '/' || item_id)),"
+                " GROUP_CONCAT(DISTINCT season || 'x' || episode), GROUP_CONCAT(DISTINCT category)"
+                " FROM announced"
+                " WHERE job = ? AND media_type = 'episode' AND added_at >= ? AND added_at < ?"
+                " GROUP BY show_key, show_year ORDER BY show_key, show_year",
+                (job, int(start), int(end))).fetchall()
+        shows = []
+        for title, year, episode_count, numbers, categories in rows:
+            seasons = {}
+            for number in numbers.split(",") if numbers else []:
+                season, episode = number.split("x")
+                seasons.setdefault(int(season), set()).add(int(episode))
+            shows.append((title or "Unknown", year, episode_count, seasons, set(categories.split(","))))
+        return shows
+
+
+class PendingBatch:
+    """
+    The items of one library's digest, staged in the history's temporary
+    table as they are formatted so they are never all held in memory.
+    commit() records them as announced once the digest is queued.
+    """
+
+    def __init__(self, history, batch, job, library, category):
+        self.history = history
+        self.batch = batch
+        self.job = job
+        self.library = library
+        self.category = category
+        self.rows = []
+
+    def add(self, media_type, item_id, title, year=None, show_id=None, show=None,
+            season=None, episode=None, added_at=None):
+        """
+        Stages an item. Episodes carry the ID of their show, and the show
+        title from the episode itself until set_shows is called.
+        """
+        self.rows.append((self.batch, self.job, self.library, self.category, media_type, str(item_id),
+                          title or "", year, show_id, show, None, season, episode,
+                          int(added_at) if added_at is not None else None))
+        if len(self.rows) >= stage_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the staged items that are still held in memory"""
+        rows, self.rows = self.rows, []
+        if rows:
+            with self.history.lock, self.history.connection:
+                self.history.connection.executemany(
+                    "INSERT INTO pending VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def set_shows(self, shows):
+        """
+        Sets the title and year of the staged episodes' shows.
+
+        Arguments:
+        shows -- dict mapping show_id to a (title, year) tuple
+        """
+        self.flush()
+        with self.history.lock, self.history.connection:
+            self.history.connection.executemany(
+                "UPDATE pending SET show = ?, show_year = ? WHERE batch = ? AND show_id = ?",
+                [(title, year, self.batch, show_id) for show_id, (title, year) in shows.items()])
+
+    def commit(self, announced_at=None):
+        """
+        Records the staged items as announced. Items already recorded for
+        the library, e.g. because it is listed in two groups, are kept as
+        they were. Items the server reported no added date for are dated
+        when they were announced, so they still show up in rollups.
+
+        Arguments:
+        announced_at -- epoch seconds the items were announced (default: now)
+        """
+        self.flush()
+        announced_at = int(announced_at if announced_at is not None else time.time())
+        with self.history.lock, self.history.connection:
+            self.history.connection.execute(
+                "INSERT OR IGNORE INTO announced"
+                " SELECT job, library, category, media_type, item_id, title, normalize_title(title), year,"
+                " show, normalize_title(show), show_year,"
+                " season, episode, COALESCE(added_at, ?), ?"
+                " FROM pending WHERE batch = ?", (announced_at, announced_at, self.batch))
+            self.history.connection.execute("DELETE FROM pending WHERE batch = ?", (self.batch,))
+
+    def discard(self):
+        """Drops the staged items, e.g. if formatting the digest failed"""
+        self.rows = []
+        with self.history.lock, self.history.connection:
+            self.history.connection.execute("DELETE FROM pending WHERE batch = ?", (self.batch,))
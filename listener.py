@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Embedded HTTP listener for media server webhooks, and a follower for Plex's
+notification stream.
+
+Plex (Plex Pass webhooks) and the Jellyfin Webhook plugin can both POST an
+event whenever media is added. The listener keeps the "new media" events,
+buffers them in memory and hands each batch to a callback once the
+debounce window has passed, so a bulk import becomes a single digest.
+Without Plex Pass, PlexAlertTracker reads the same information from the
+websocket every Plex server provides.
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    # Used by plexapi's AlertListener to follow the notification stream
+    import websocket
+except ImportError:
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+# Plex timeline entry states (see plexapi.alert.AlertListener)
+PLEX_ITEM_CREATED = 0
+PLEX_ITEM_PROCESSED = 5
+
+
+def parse_plex_webhook(body, content_type):
+    """
+    Returns the Metadata of a Plex library.new event, or None for any other
+    event. Plex sends the event as JSON in the "payload" field of a
+    multipart/form-data body.
+    """
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == "payload":
+            payload = json.loads(part.get_content())
+            if payload.get("event") == "library.new":
+                return payload.get("Metadata")
+    return None
+
+
+def parse_jellyfin_webhook(body, content_type):
+    """
+    Returns the body of a Jellyfin Webhook plugin ItemAdded notification, or
+    None for any other notification.
+    """
+    payload = json.loads(body)
+    if payload.get("NotificationType") == "ItemAdded":
+        return payload
+    return None
+
+
+class EventBuffer:
+    """
+    Collects events and passes them to flush() in one batch, debounce
+    seconds after the first event of the batch arrived. Batches are flushed
+    one at a time.
+    """
+
+    def __init__(self, debounce, flush):
+        self.debounce = debounce
+        self.flush = flush
+        self.events = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+            if self.timer is None:
+                self.timer = threading.Timer(self.debounce, self._flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush(self):
+        with self.flush_lock:
+            with self.lock:
+                events, self.events = self.events, []
+                self.timer = None
+            try:
+                self.flush(events)
+            except Exception as err:
+                logger.error(f"Processing webhook events failed: {str(err)}")
+
+
+class PlexAlertTracker:
+    """
+    Follows the timeline entries of a Plex server's notification stream.
+    Items are remembered when Plex creates them in one of the watched
+    sections and passed to the buffer once Plex has finished processing
+    their metadata, so the digest shows their proper titles. Items that are
+    only refreshed or edited were never created and are ignored.
+
+    Arguments:
+    path -- path the events are tagged with, as for webhooks
+    section_ids -- keys of the library sections to watch
+    types -- Plex metadata type numbers to watch (see sources.plex_types)
+    buffer -- EventBuffer the processed items are added to
+    max_pending -- items waiting for their metadata that are remembered;
+                   beyond that the oldest are forgotten
+    """
+
+    def __init__(self, path, section_ids, types, buffer, max_pending=10000):
+        self.path = path
+        self.section_ids = {str(section_id) for section_id in section_ids}
+        self.types = set(types)
+        self.buffer = buffer
+        self.max_pending = max_pending
+        # item ID -> section ID, oldest first
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    def handle(self, data):
+        """Callback for plexapi's AlertListener"""
+        if data.get("type") != "timeline":
+            return
+        for entry in data.get("TimelineEntry", []):
+            section_id = str(entry.get("sectionID"))
+            if (entry.get("identifier") != "com.plexapp.plugins.library"
+                    or section_id not in self.section_ids
+                    or entry.get("type") not in self.types):
+                continue
+
+            item_id = str(entry.get("itemID"))
+            state = entry.get("state")
+            with self.lock:
+                if state == PLEX_ITEM_CREATED and entry.get("metadataState") == "created":
+                    self.pending[item_id] = section_id
+                    while len(self.pending) > self.max_pending:
+                        self.pending.popitem(last=False)
+                    continue
+                if state != PLEX_ITEM_PROCESSED or self.pending.pop(item_id, None) is None:
+                    continue
+            self.buffer.add((self.path, {"itemID": item_id, "sectionID": section_id, "type": entry["type"]}))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Set on the subclass created by start_listener
+    parsers = {}
+    buffer = None
+    token = ""
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if self.token and parse_qs(url.query).get("token", [""])[0] != self.token:
+            self.send_response(403)
+            self.end_headers()
+            return
+        parser = self.parsers.get(url.path.rstrip("/"))
+        if parser is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            event = parser(body, self.headers.get("Content-Type", ""))
+        except ValueError as err:
+            logger.warning(f"Ignoring malformed webhook on {url.path}: {str(err)}")
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        if event:
+            # Tagged with the path so the events can be routed to the
+            # server that sent them
+            self.buffer.add((url.path.rstrip("/"), event))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_listener(host, port, parsers, buffer, token=""):
+    """
+    Creates the webhook HTTP server. Call serve_forever() on the result to
+    start handling requests.
+
+    Arguments:
+    host -- interface to listen on
+    port -- port to listen on
+    parsers -- dict mapping URL path (e.g. "/plex") to a parse function
+    buffer -- EventBuffer the parsed events are added to, as (path, event) tuples
+    token -- optional secret that must be given as ?token= on every request
+    """
+    handler = type("Handler", (WebhookHandler,), {
+        "parsers": parsers,
+        "buffer": buffer,
+        "token": token
+    })
+    return ThreadingHTTPServer((host, port), handler)
@@ -1,25 +1,41 @@
 # -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import functools
+import itertools
+import os
 import re
-import requests
+import sqlite3
 import sys
 import time
 import yaml
 import logging
-from collections import Counter
-from dhooks import Webhook, Embed
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import async_engine
+from cache import MetadataCache
+from dhooks import Embed
 from pathlib import Path
-from plexapi.server import PlexServer
-import schedule
 import threading
 from datetime import datetime, timedelta
-
-# Configure logging
+from dispatcher import WebhookDispatcher
+from history import History
+from listener import EventBuffer, PlexAlertTracker, start_listener, websocket
+from metrics import Metrics, TimedAsyncIterator, TimedIterator, instrument_session, start_metrics_server
+from outbox import Outbox
+from sources import SOURCES, plex_types
+from state import StateStore
+from storage import atomic_write_json
+from transport import DEFAULT_OPTIONS, create_session
+
+# Configure logging. LOG_DIR lets the app run outside the container.
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s | %(levelname)-7s | %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
     handlers=[
-        logging.FileHandler('/app/logs/app.log'),
+        logging.FileHandler(os.path.join(os.environ.get('LOG_DIR', '/app/logs'), 'app.log')),
         logging.StreamHandler()
     ]
 )
@@ -33,12 +49,9 @@ This script is meant to check your Plex or Jellyfin server, retrieve lists of
 shows and movies that are in the Recently Added sections, count and
 format them nicely, and then output to a message via discord webhook.
 
-If the lists of media (one for Movies and one for TV) are longer than
-discord's max message length (currently set as 4096 chars but can be changed
-in the "USER OPTIONS" section below), they will be cut down to size.
-
-i.e: If the sum of the length of both lists is over the
-max length, they will each be trimmed down to half of the max size.
+If the lists of media are longer than discord allows in a single embed or
+message, they are split on line breaks into continuation embeds, which are
+packed into as few messages as discord's limits allow.
 
 The script is meant to be run on a schedule (e.g. via crontab or unraid
 user scripts). By default, it should be run every 24 hours, but if you
@@ -49,9 +62,6 @@ To get the script working with minimal configuration, you will need to change
 these variables to match your plex/jellyfin/discord info; they're in the
 "USER OPTIONS" section below.
 
-NOTE: Do not set the lookback_period variable to be too far back, or the list
-of media may be cut off.
-
 ------------------------------------------------------------------------------
 DEPENDENCIES
 
@@ -91,299 +101,357 @@ start_time = int(time.time())
 with open(Path(__file__).with_name("config.yml"), encoding="utf-8") as file:
     config = yaml.safe_load(file)
 
-# Determine platform (plex or jellyfin)
-platform = config.get("platform", "plex").lower()
-if platform not in ["plex", "jellyfin"]:
-    logger.error("Platform must be either 'plex' or 'jellyfin'")
+# Character limit of a single embed's description (discord allows 4096)
+message_max_length = 4000
+
+# Discord limits on a single message: at most 10 embeds, and at most 6000
+# characters across the titles, descriptions and footers of all of them
+message_max_embeds = 10
+message_max_total_length = 6000
+
+# Smallest part of a description worth adding to a message that already
+# holds embeds; with less room left, a new message is started instead
+message_min_room = 100
+
+# Optional HTTP listener for Plex/Jellyfin webhooks, used instead of
+# polling the libraries on a schedule
+listener_options = {
+    "enabled": False,
+    "host": "0.0.0.0",
+    "port": 8585,
+    "token": "",
+    "debounce": "5m"
+}
+listener_options.update(config.get("webhook_listener") or {})
+
+# Optionally follow the notification stream of every Plex server, which
+# reports new media like webhooks do but without needing Plex Pass
+alert_options = {
+    "enabled": False,
+    "debounce": "1m"
+}
+alert_options.update(config.get("plex_alerts") or {})
+if alert_options["enabled"] and websocket is None:
+    logger.error("plex_alerts requires websocket-client (pip install websocket-client)")
     sys.exit(1)
 
-logger.info(f"Using platform: {platform}")
+# Scheduled updates announce fixed windows of each job's lookback period,
+# aligned to the wall clock. After downtime, the missed windows are
+# announced together, going back at most max_catch_up.
+scheduler_options = {
+    "max_catch_up": "7d"
+}
+scheduler_options.update(config.get("scheduler") or {})
+
+# Windows are counted from midnight on a Monday, local time, so "1d" runs
+# at midnight, "4h" at 00:00, 04:00, 08:00... and "1w" on Mondays
+schedule_anchor = datetime(2024, 1, 1)
+
+# Rollup periods, each announced once it is over, with the heading of its
+# message. Weeks start on Monday.
+rollup_titles = {
+    "daily": "Added on {start:%A %Y-%m-%d}",
+    "weekly": "Added in the week of {start:%Y-%m-%d}",
+    "monthly": "Added in {start:%B %Y}"
+}
+
+# Longest single sleep while waiting for the next window, so a change of the
+# system clock or a suspended host delays an update by at most this long
+max_sleep = 300
+
+# Directory for files that persist between runs and restarts
+data_dir = Path(config.get("data_dir", "/app/data"))
+
+# Remembers what has already been announced for each library so that a run
+# only queries media added since the last successful send
+state = StateStore(data_dir / "state.json")
+
+# Every announced item is recorded in history.db, from which the daily,
+# weekly and monthly rollups are built without querying the media server
+history_options = {
+    "enabled": True
+}
+history_options.update(config.get("history") or {})
+history = History(data_dir / "history.db") if history_options["enabled"] else None
+
+# Pooled HTTP session shared by the media server clients, the webhook and
+# the uptime ping so connections are reused between requests
+http_options = dict(DEFAULT_OPTIONS)
+http_options.update(config.get("http") or {})
+http_session = create_session(http_options)
+
+# Phase timings and HTTP request counts, served on /metrics and written as
+# a JSON report after every run when enabled
+metrics_options = {
+    "enabled": False,
+    "host": "0.0.0.0",
+    "port": 9585,
+    "run_report": True
+}
+metrics_options.update(config.get("metrics") or {})
+metrics = Metrics()
+instrument_session(http_session, metrics)
+
+# Paces webhook messages to Discord's rate limits
+dispatcher = WebhookDispatcher(http_session)
+async_dispatcher = async_engine.AsyncWebhookDispatcher()
+
+# "threads" runs the scheduled updates on a thread pool with blocking
+# requests; "async" runs them on one asyncio event loop with aiohttp
+engine = config.get("engine", "threads")
+if engine not in ("threads", "async"):
+    logger.error("engine must be \"threads\" or \"async\"")
+    sys.exit(1)
+if engine == "async" and async_engine.aiohttp is None:
+    logger.error("The async engine requires aiohttp (pip install aiohttp)")
+    sys.exit(1)
 
-if platform == "plex":
-    script_config = config["plex_discord_media_updates"]
-    try:
-        testing_mode = script_config["testing_mode"]
-    except:
-        testing_mode = False
-    try:
-        uptime_status = config["uptime_status"]["plex_discord_media_updates"]
-    except:
-        uptime_status = None
-    plex_url = config["plex"]["url"]
-    plex_token = config["plex"]["token"]
-    webhook_url = script_config["webhook"]
-    lookback_period = script_config["lookback_period"]
-    skip_libraries = script_config["skip_libraries"]
-    show_total_episodes = script_config["show_total_episode_count"]
-    show_individual_episodes = script_config["show_episode_count_per_show"]
-    message_title = script_config["message_options"]["titles"]
-    embed_options = script_config["embed_options"]
-    embed_thumbnail = embed_options["thumbnail"]
-    bullet = embed_options["bullet"]
-    max_length_exceeded_msg = script_config["overflow_footer"]
-
-    # Library categories and their settings
-    library_categories = {
-        "movies": {
-            "library": config["plex"]["libraries"]["movies"],
-            "colour": embed_options["movies_colour"],
-            "emote": embed_options["movies_emote"],
-            "skip": skip_libraries["movies"]
-        },
-        "shows": {
-            "library": config["plex"]["libraries"]["shows"],
-            "colour": embed_options["shows_colour"],
-            "emote": embed_options["shows_emote"],
-            "skip": skip_libraries["shows"]
-        },
-        "kids_movies": {
-            "library": config["plex"]["libraries"]["kids_movies"],
-            "colour": embed_options["kids_movies_colour"],
-            "emote": embed_options["kids_movies_emote"],
-            "skip": skip_libraries["kids_movies"]
-        },
-        "kids_shows": {
-            "library": config["plex"]["libraries"]["kids_shows"],
-            "colour": embed_options["kids_shows_colour"],
-            "emote": embed_options["kids_shows_emote"],
-            "skip": skip_libraries["kids_shows"]
-        },
-        "anime_movies": {
-            "library": config["plex"]["libraries"]["anime_movies"],
-            "colour": embed_options["anime_movies_colour"],
-            "emote": embed_options["anime_movies_emote"],
-            "skip": skip_libraries["anime_movies"]
-        },
-        "anime_shows": {
-            "library": config["plex"]["libraries"]["anime_shows"],
-            "colour": embed_options["anime_shows_colour"],
-            "emote": embed_options["anime_shows_emote"],
-            "skip": skip_libraries["anime_shows"]
-        },
-        "uhd_movies": {
-            "library": config["plex"]["libraries"]["uhd_movies"],
-            "colour": embed_options["uhd_movies_colour"],
-            "emote": embed_options["uhd_movies_emote"],
-            "skip": skip_libraries["uhd_movies"]
-        },
-        "uhd_shows": {
-            "library": config["plex"]["libraries"]["uhd_shows"],
-            "colour": embed_options["uhd_shows_colour"],
-            "emote": embed_options["uhd_shows_emote"],
-            "skip": skip_libraries["uhd_shows"]
-        },
-        "mux_movies": {
-            "library": config["plex"]["libraries"]["mux_movies"],
-            "colour": embed_options["mux_movies_colour"],
-            "emote": embed_options["mux_movies_emote"],
-            "skip": skip_libraries["mux_movies"]
-        },
-        "mux_shows": {
-            "library": config["plex"]["libraries"]["mux_shows"],
-            "colour": embed_options["mux_shows_colour"],
-            "emote": embed_options["mux_shows_emote"],
-            "skip": skip_libraries["mux_shows"]
-        }
-    }
-else:  # jellyfin
-    script_config = config["jellyfin_discord_media_updates"]
-    try:
-        testing_mode = script_config["testing_mode"]
-    except:
-        testing_mode = False
-    try:
-        uptime_status = config["uptime_status"]["jellyfin_discord_media_updates"]
-    except:
-        uptime_status = None
-    jellyfin_url = config["jellyfin"]["url"]
-    jellyfin_api_key = config["jellyfin"]["api_key"]
-    webhook_url = script_config["webhook"]
-    lookback_period = script_config["lookback_period"]
-    skip_libraries = script_config["skip_libraries"]
-    show_total_episodes = script_config["show_total_episode_count"]
-    show_individual_episodes = script_config["show_episode_count_per_show"]
-    message_title = script_config["message_options"]["titles"]
-    embed_options = script_config["embed_options"]
-    embed_thumbnail = embed_options["thumbnail"]
-    bullet = embed_options["bullet"]
-    max_length_exceeded_msg = script_config["overflow_footer"]
-
-    # Library categories and their settings
-    library_categories = {
-        "movies": {
-            "library": config["jellyfin"]["libraries"]["movies"],
-            "colour": embed_options["movies_colour"],
-            "emote": embed_options["movies_emote"],
-            "skip": skip_libraries["movies"]
-        },
-        "shows": {
-            "library": config["jellyfin"]["libraries"]["shows"],
-            "colour": embed_options["shows_colour"],
-            "emote": embed_options["shows_emote"],
-            "skip": skip_libraries["shows"]
-        },
-        "kids_movies": {
-            "library": config["jellyfin"]["libraries"]["kids_movies"],
-            "colour": embed_options["kids_movies_colour"],
-            "emote": embed_options["kids_movies_emote"],
-            "skip": skip_libraries["kids_movies"]
-        },
-        "kids_shows": {
-            "library": config["jellyfin"]["libraries"]["kids_shows"],
-            "colour": embed_options["kids_shows_colour"],
-            "emote": embed_options["kids_shows_emote"],
-            "skip": skip_libraries["kids_shows"]
-        },
-        "anime_movies": {
-            "library": config["jellyfin"]["libraries"]["anime_movies"],
-            "colour": embed_options["anime_movies_colour"],
-            "emote": embed_options["anime_movies_emote"],
-            "skip": skip_libraries["anime_movies"]
-        },
-        "anime_shows": {
-            "library": config["jellyfin"]["libraries"]["anime_shows"],
-            "colour": embed_options["anime_shows_colour"],
-            "emote": embed_options["anime_shows_emote"],
-            "skip": skip_libraries["anime_shows"]
-        },
-        "uhd_movies": {
-            "library": config["jellyfin"]["libraries"]["uhd_movies"],
-            "colour": embed_options["uhd_movies_colour"],
-            "emote": embed_options["uhd_movies_emote"],
-            "skip": skip_libraries["uhd_movies"]
-        },
-        "uhd_shows": {
-            "library": config["jellyfin"]["libraries"]["uhd_shows"],
-            "colour": embed_options["uhd_shows_colour"],
-            "emote": embed_options["uhd_shows_emote"],
-            "skip": skip_libraries["uhd_shows"]
-        },
-        "mux_movies": {
-            "library": config["jellyfin"]["libraries"]["mux_movies"],
-            "colour": embed_options["mux_movies_colour"],
-            "emote": embed_options["mux_movies_emote"],
-            "skip": skip_libraries["mux_movies"]
-        },
-        "mux_shows": {
-            "library": config["jellyfin"]["libraries"]["mux_shows"],
-            "colour": embed_options["mux_shows_colour"],
-            "emote": embed_options["mux_shows_emote"],
-            "skip": skip_libraries["mux_shows"]
+# Webhook messages are kept on disk until Discord accepts them, and retried
+# with exponential backoff in the meantime
+outbox_options = {
+    "backoff_seconds": 30,
+    "max_backoff_seconds": 3600,
+    "max_age_days": 7
+}
+outbox_options.update(config.get("outbox") or {})
+outbox = Outbox(
+    data_dir / "outbox.json",
+    outbox_options["backoff_seconds"],
+    outbox_options["max_backoff_seconds"],
+    outbox_options["max_age_days"] * 86400)
+
+# Show titles and years, shared by every library and job so each show is
+# only looked up once per ttl_days
+show_cache_options = {
+    "max_entries": 10000,
+    "ttl_days": 7,
+    "persist": True
+}
+show_cache_options.update(config.get("show_cache") or {})
+show_cache = MetadataCache(
+    show_cache_options["max_entries"],
+    show_cache_options["ttl_days"] * 86400,
+    data_dir / "show_cache.json" if show_cache_options["persist"] else None)
+
+
+class Job:
+    """
+    Announces the recently added media of one media server to one discord
+    webhook. Several jobs may share a server.
+
+    Arguments:
+    name -- unique name, used to key the job's state
+    source -- the MediaSource to read new media from
+    server_config -- the server's settings (for its libraries)
+    script_config -- the job's settings, laid out like a
+                     *_discord_media_updates section
+    """
+
+    def __init__(self, name, source, server_config, script_config):
+        self.name = name
+        self.source = source
+        self.webhook_path = f"/{source.name}"
+        self.webhook_url = script_config["webhook"]
+        if script_config.get("testing_mode", False):
+            self.webhook_url = script_config["testing"]["webhook"]
+        self.uptime_status = script_config.get("uptime_status")
+        self.lookback_period = script_config["lookback_period"]
+        self.show_total_episodes = script_config["show_total_episode_count"]
+        self.show_individual_episodes = script_config["show_episode_count_per_show"]
+        self.show_episode_numbers = script_config.get("show_episode_numbers", False)
+        self.merge_duplicates = script_config.get("merge_duplicates", True)
+        # "daily", "weekly" and/or "monthly", built from the history
+        self.rollups = script_config.get("rollups") or []
+        self.message_titles = script_config["message_options"]["titles"]
+        self.library_groups = script_config["library_groups"]
+        # Number of libraries that are queried at the same time
+        self.max_concurrency = script_config.get("max_concurrency", 4)
+
+        embed_options = script_config["embed_options"]
+        self.embed_thumbnail = embed_options["thumbnail"]
+        self.bullet = embed_options["bullet"]
+
+        # Library categories and their settings
+        skip_libraries = script_config["skip_libraries"]
+        self.library_categories = {
+            category: {
+                "library": library,
+                "colour": embed_options[f"{category}_colour"],
+                "emote": embed_options[f"{category}_emote"],
+                "badge": embed_options.get(f"{category}_badge", library),
+                "skip": skip_libraries[category]
+            }
+            for category, library in server_config["libraries"].items()
         }
-    }
 
-# Character limit of a discord message including embeds
-message_max_length = 4000
+    def enabled_categories(self):
+        """
+        Returns every library category enabled in at least one group, in the
+        configured order and without duplicates.
+        """
+        return list(dict.fromkeys(
+            category
+            for group_config in self.library_groups.values()
+            for category in group_config["libraries"]
+            if not self.library_categories[category]["skip"]))
 
-if testing_mode:
-    webhook_url = script_config["testing"]["webhook"]
+    def state_key(self, category):
+        """Key of a library's watermark in the state store"""
+        return f"{self.name}:{self.library_categories[category]['library']}"
 
-class JellyfinClient:
-    def __init__(self, url, api_key):
-        self.url = url.rstrip('/')
-        self.api_key = api_key
-        self.headers = {
-            'X-Emby-Token': api_key,
-            'Content-Type': 'application/json'
-        }
-    
-    def get_libraries(self):
-        """Get all libraries from Jellyfin"""
-        response = requests.get(f"{self.url}/Users/Items", headers=self.headers)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"Failed to get libraries: {response.status_code}")
-    
-    def get_library_items(self, library_id, item_type=None, date_added_after=None):
-        """Get items from a specific library"""
-        params = {
-            'ParentId': library_id,
-            'IncludeItemTypes': item_type,
-            'Recursive': True,
-            'SortBy': 'DateCreated',
-            'SortOrder': 'Descending'
-        }
-        
-        if date_added_after:
-            params['DateCreated'] = f">{date_added_after}"
-        
-        response = requests.get(f"{self.url}/Users/Items", headers=self.headers, params=params)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"Failed to get library items: {response.status_code}")
-    
-    def get_item(self, item_id):
-        """Get a specific item by ID"""
-        response = requests.get(f"{self.url}/Users/Items/{item_id}", headers=self.headers)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"Failed to get item: {response.status_code}")
 
-def clean_year(media):
+def merge_config(defaults, overrides):
+    """
+    Returns a copy of the defaults dict with the overrides merged in,
+    recursing into nested dicts so a job only has to list what differs.
+    """
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_config(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def load_jobs(config):
+    """
+    Builds the jobs described by config.yml. Multiple servers and webhooks
+    are configured with the "servers" and "jobs" sections. Otherwise the
+    single-server layout is used: "platform" (a name or a list of names)
+    with each platform's server section and *_discord_media_updates section.
+    Servers are shared by all jobs that use them.
+    """
+    if "jobs" in config:
+        servers_config = config.get("servers") or {}
+        job_defaults = config.get("job_defaults") or {}
+        jobs_config = {name: merge_config(job_defaults, job_config)
+                       for name, job_config in config["jobs"].items()}
+    else:
+        platforms = config.get("platform", "plex")
+        if isinstance(platforms, str):
+            platforms = [platforms]
+        platforms = [platform.lower() for platform in platforms]
+        servers_config = {platform: dict(config[platform], platform=platform)
+                          for platform in platforms if platform in config}
+        jobs_config = {}
+        for platform in platforms:
+            section = f"{platform}_discord_media_updates"
+            job_config = dict(config.get(section) or {}, server=platform)
+            try:
+                job_config.setdefault("uptime_status", config["uptime_status"][section])
+            except (KeyError, TypeError):
+                pass
+            jobs_config[platform] = job_config
+
+    sources = {}
+    for name, server_config in servers_config.items():
+        platform = str(server_config.get("platform", "")).lower()
+        if platform not in SOURCES:
+            logger.error(f"Platform of server '{name}' must be one of: {', '.join(SOURCES)}")
+            sys.exit(1)
+        sources[name] = SOURCES[platform].from_config(name, server_config, http_session, http_options)
+
+    jobs = []
+    for name, job_config in jobs_config.items():
+        server_name = job_config.get("server")
+        if server_name not in sources:
+            logger.error(f"Job '{name}' uses unknown server '{server_name}'")
+            sys.exit(1)
+        job = Job(name, sources[server_name], servers_config[server_name], job_config)
+        unknown = [kind for kind in job.rollups if kind not in rollup_titles]
+        if unknown:
+            logger.error(f"Job '{name}' has unknown rollups: {', '.join(unknown)}"
+                         f" (use {', '.join(rollup_titles)})")
+            sys.exit(1)
+        if job.rollups and history is None:
+            logger.error(f"Job '{name}' has rollups, which need history.enabled")
+            sys.exit(1)
+        jobs.append(job)
+        logger.info(f"Job {name}: {sources[server_name].platform} server '{server_name}'")
+    if not jobs:
+        logger.error("No jobs configured")
+        sys.exit(1)
+    return jobs
+
+
+configured_jobs = load_jobs(config)
+
+
+def clean_year(title, year):
     """
-    Takes a Show/Movie object and returns the title of it with the year
-    properly appended. Prevents media with the year already in the title
-    from having duplicate years. (e.g., avoids situations like
+    Takes the title and year of a Show/Movie and returns the title with the
+    year properly appended. Prevents media with the year already in the
+    title from having duplicate years. (e.g., avoids situations like
     "The Flash (2014) (2014)").
 
     Arguments:
-    media -- an object with both .title and .year variables (Plex) or dict with Name and ProductionYear (Jellyfin)
+    title -- the show or movie title
+    year -- the release year, or None if it is unknown
     """
-    title = ""
     # year_regex matches any string ending with a year between 1000-2999 in
     # parentheses. e.g. "The Flash (2014)"
-    year_regex = re.compile(".*\([12][0-9]{3}\)$")
-    
-    if platform == "plex":
-        title += media.title
-        if not year_regex.match(media.title):
-            title += " (" + str(media.year) + ")"
-    else:  # jellyfin
-        title += media.get('Name', 'Unknown')
-        if not year_regex.match(title):
-            year = media.get('ProductionYear')
-            if year:
-                title += f" ({year})"
-    
+    year_regex = re.compile(r".*\([12][0-9]{3}\)$")
+
+    if year and not year_regex.match(title):
+        title += f" ({year})"
     return title
 
 
-def trim_on_newlines(long_string, max_length):
+def episode_ranges(seasons):
+    """
+    Compresses episode numbers into ranges, e.g. "S02E01–E10, S03E01". Runs
+    of consecutive episodes become one span, and the season is only named
+    once (e.g. "S01E01–E03, E05").
+
+    Arguments:
+    seasons -- dict mapping season number to a set of episode numbers
+    """
+    parts = []
+    for season in sorted(seasons):
+        spans = []
+        for number in sorted(seasons[season]):
+            if spans and number == spans[-1][1] + 1:
+                spans[-1][1] = number
+            else:
+                spans.append([number, number])
+        for i, (first, last) in enumerate(spans):
+            span = f"E{first:02d}" if first == last else f"E{first:02d}–E{last:02d}"
+            parts.append(f"S{season:02d}{span}" if i == 0 else span)
+    return ", ".join(parts)
+
+
+def split_on_newline(long_string, max_length):
     """
-    Takes a long multi-line string and a max length, and returns a subsection
-    of the string that's the max length or shorter, that ends before a
-    newline.
+    Takes a long multi-line string and a max length, and splits it in two:
+    the longest leading part that is the max length or shorter and ends
+    before a newline, and the rest. The first part is empty if no line
+    break falls within max_length.
 
     Arguments:
     long_string -- string; any string with a newline character
-    max_length -- integer; denotes the max length to trim the string down to
+    max_length -- integer; denotes the max length of the first part
     """
-    if len(long_string) > max_length:
-        end = long_string.rfind("\n", 0, max_length)
-        return long_string[:end] + max_length_exceeded_msg
-    else:
-        return long_string + max_length_exceeded_msg
+    if max_length < 0:
+        raise ValueError(f"max_length must not be negative: {max_length}")
+    if len(long_string) <= max_length:
+        return long_string, ""
+    end = long_string.rfind("\n", 0, max_length + 1)
+    if end <= 0:
+        return "", long_string
+    return long_string[:end], long_string[end + 1:]
 
 
-def create_embeds(embed_title, embed_description, embed_color, max_length, webhook_embeds):
+def create_embeds(embed_title, embed_description, embed_color, webhook_embeds):
     """
-    Creates an embed with data from the given arguments, but modifies the
-    description of the embed so be below a given amount of characters. Will
-    only trim the embed at the end of a line to avoid partial lines, while
-    still keeping the description below max_length.
+    Creates an embed with data from the given arguments. Descriptions that
+    are too long for discord are split up later by pack_embeds.
 
     Arguments:
     embed_title -- title for the embed
     embed_description -- description for the embed
     embed_color -- colour for the embed
-    max_length -- integer; the max length for the embed's description
     webhook_embeds -- list to append the created embed to
     """
-    if len(embed_description) > max_length:
-        embed_description = trim_on_newlines(embed_description, max_length)
     embed = Embed(
         title=embed_title,
         description=embed_description,
@@ -391,303 +459,1482 @@ def create_embeds(embed_title, embed_description, embed_color, max_length, webho
     webhook_embeds.append(embed)
 
 
-def parse_lookback_period(lookback_period):
-    """Convert lookback period string to datetime"""
-    unit = lookback_period[-1]
-    value = int(lookback_period[:-1])
-    
-    now = datetime.now()
+def pack_embeds(webhook_embeds):
+    """
+    Packs embeds, in order, into as few messages as discord's limits allow
+    (message_max_embeds embeds and message_max_total_length characters per
+    message, message_max_length characters per description). A description
+    that does not fit is split at the end of a line to fill the current
+    message, and carries on in "(continued)" embeds in the following
+    messages, so no entries are lost. Returns a list of embed lists, one per
+    message.
+
+    Arguments:
+    webhook_embeds -- list of embeds with a title, description and colour
+    """
+    messages = []
+    current = []
+    current_length = 0
+    for embed in webhook_embeds:
+        title = embed.title
+        description = embed.description
+        while True:
+            room = min(message_max_length,
+                       message_max_total_length - current_length - len(title))
+            if current and room < len(description) and room < message_min_room:
+                # Too little room left for a useful part; start a new message
+                messages.append(current)
+                current = []
+                current_length = 0
+                continue
+            part, description = split_on_newline(description, room)
+            if not part and current:
+                # Not even one more line fits; start a new message
+                messages.append(current)
+                current = []
+                current_length = 0
+                continue
+            if not part:
+                # A single line longer than a whole message has to be cut
+                part, description = description[:room], description[room:]
+
+            current.append(Embed(title=title, description=part, color=embed.color))
+            current_length += len(title) + len(part)
+            if len(current) == message_max_embeds:
+                messages.append(current)
+                current = []
+                current_length = 0
+            if not description:
+                break
+            title = f"{embed.title} (continued)"
+    if current:
+        messages.append(current)
+    return messages
+
+
+def parse_period(period):
+    """Convert a period string such as "4h" to a timedelta"""
+    unit = period[-1]
+    value = int(period[:-1])
+
     if unit == 'm':
-        return now - timedelta(minutes=value)
+        return timedelta(minutes=value)
     elif unit == 'h':
-        return now - timedelta(hours=value)
+        return timedelta(hours=value)
     elif unit == 'd':
-        return now - timedelta(days=value)
+        return timedelta(days=value)
     elif unit == 'w':
-        return now - timedelta(weeks=value)
+        return timedelta(weeks=value)
     else:
         raise ValueError(f"Invalid lookback period unit: {unit}")
 
 
-def run_update():
+def window_end(period, now):
     """
-    Main function that runs the update process
+    Returns the end of the newest complete window of a lookback period at
+    the given time: the last whole multiple of the period since
+    schedule_anchor.
+    """
+    length = parse_period(period)
+    return schedule_anchor + ((now - schedule_anchor) // length) * length
+
+
+def next_window_end(jobs):
+    """Returns the time the next window of any of the jobs ends"""
+    now = datetime.now()
+    return min(window_end(job.lookback_period, now) + parse_period(job.lookback_period)
+               for job in jobs)
+
+
+def job_window(job, until=None):
+    """
+    Returns the (start, end) datetimes of the media a job announces next, or
+    None if nothing is due. The window ends at the end of the job's newest
+    complete window (see window_end), or at until if given. It starts where
+    the last announced window ended, so windows missed while the app was
+    down are announced together, but at most max_catch_up before the end.
+    On the first run it covers one lookback period.
+    """
+    end = until or window_end(job.lookback_period, datetime.now())
+    last_end = state.get_window(job.name)
+    if last_end is None:
+        start = end - parse_period(job.lookback_period)
+    else:
+        start = datetime.fromtimestamp(last_end)
+    start = max(start, end - parse_period(scheduler_options["max_catch_up"]))
+    if start >= end:
+        return None
+    return start, end
+
+
+def due_windows(jobs, until=None):
+    """Returns a dict mapping every job with a window due to its window (see job_window)"""
+    windows = {}
+    for job in jobs:
+        window = job_window(job, until)
+        if window is not None:
+            windows[job] = window
+    return windows
+
+
+def library_threshold(job, category, since):
+    """
+    Returns the datetime to query a library from: the start of the window,
+    or the library's watermark if it was announced more recently.
+    """
+    watermark = state.get_watermark(job.state_key(category))
+    if watermark is not None:
+        return max(since, datetime.fromtimestamp(watermark))
+    return since
+
+
+def query_start(start):
+    """
+    Returns the datetime to query a server from for the media added at or
+    after start. The servers only return media added after the time asked
+    for, so they are asked from a second earlier and in_window leaves out
+    what came before start.
+    """
+    return start - timedelta(seconds=1)
+
+
+def in_window(item, start, end):
+    """
+    Returns whether an item was added within a window. Windows include
+    their start but not their end, so an item added on a boundary belongs
+    to exactly one of them; items with no added time are kept.
+    """
+    return item.added_at is None or start.timestamp() <= item.added_at < end.timestamp()
+
+
+def media_type_of(category, reported=None):
+    """
+    Returns the media type ("movie" or "episode") of a library: the type
+    its server reported (see MediaSource.library), or if the server does
+    not say, as for a Jellyfin library of mixed content, the type its
+    category's name suggests.
+    """
+    if reported is not None:
+        return reported
+    return "movie" if "movies" in category else "episode"
+
+
+def library_media_type(job, category):
+    """media_type_of a job's library, asking its server. Safe to call from worker threads."""
+    _, reported = job.source.library(job.library_categories[category]["library"])
+    return media_type_of(category, reported)
+
+
+def query_library(job, category, media_type, window):
+    """
+    Queries a single library for media added within a window, from its
+    threshold (see library_threshold) on. Media added in the second of the
+    watermark itself is left to state.is_announced. Returns an iterator of RecentItem
+    records, fetched page by page as it is consumed. Safe to call from
+    worker threads.
+
+    Arguments:
+    job -- the Job the library belongs to
+    category -- key of the library in job.library_categories
+    media_type -- "movie" or "episode", see library_media_type
+    window -- (start, end) datetimes, see job_window
+    """
+    settings = job.library_categories[category]
+    start, end = window
+    threshold = library_threshold(job, category, start)
+    items = job.source.recent_items(settings["library"], media_type, query_start(threshold))
+    return (item for item in items if in_window(item, threshold, end))
+
+
+class NewestItems:
+    """
+    Keeps the newest added time seen and the IDs added at that time. That
+    is all of an announcement the state store keeps, so the IDs of a bulk
+    import do not have to be held until it is sent.
+    """
+
+    def __init__(self):
+        self.added_at = None
+        self.item_ids = []
+
+    def add(self, item):
+        if item.added_at is None:
+            return
+        if self.added_at is None or item.added_at > self.added_at:
+            self.added_at = item.added_at
+            self.item_ids = [item.item_id]
+        elif item.added_at == self.added_at:
+            self.item_ids.append(item.item_id)
+
+    def pairs(self):
+        """(item_id, added_at) pairs for StateStore.advance"""
+        return [(item_id, self.added_at) for item_id in self.item_ids]
+
+
+def cached_show_titles(source, episodes):
+    """
+    Returns a (shows, missing) tuple for the shows of the episodes: shows
+    maps the show_id of each show in show_cache to a (title, year) tuple,
+    and missing lists the IDs of the shows that have to be looked up.
+    """
+    shows = {}
+    missing = []
+    for show_id in dict.fromkeys(episode.show_id for episode in episodes):
+        if show_id is None:
+            continue
+        cached = show_cache.get(f"{source.name}:{show_id}")
+        if cached is not None:
+            shows[show_id] = cached
+        else:
+            missing.append(show_id)
+    return shows, missing
+
+
+def cache_show_titles(source, shows, found):
+    """Adds the shows looked up on a server, as returned by show_titles, to shows and show_cache"""
+    for show_id, show in found.items():
+        show_cache.put(f"{source.name}:{show_id}", show)
+    shows.update(found)
+
+
+def lookup_show_titles(source, episodes):
+    """
+    Returns a dict mapping show_id to a (title, year) tuple for the shows of
+    the episodes, like MediaSource.show_titles, but only looks up the shows
+    that are not in show_cache.
+    """
+    shows, missing = cached_show_titles(source, episodes)
+    if missing:
+        missing_ids = set(missing)
+        cache_show_titles(source, shows, source.show_titles(
+            [episode for episode in episodes if episode.show_id in missing_ids]))
+    return shows
+
+
+class LibraryDigest:
+    """
+    Folds the new media of a single library into what its embed needs, one
+    item at a time: movies into their lines, episodes into per-show counts.
+    Media already announced by an earlier run is left out. The items are
+    staged in the history as they arrive, if it is enabled; the staged
+    items are dropped if the with block fails or nothing is new.
+
+    Arguments:
+    job -- the Job the library belongs to
+    category -- key of the library in job.library_categories
+    media_type -- "movie" or "episode", see media_type_of
+    """
+
+    def __init__(self, job, category, media_type):
+        self.job = job
+        self.category = category
+        self.media_type = media_type
+        self.state_key = job.state_key(category)
+        self.newest = NewestItems()
+        self.pending = None
+        if history is not None:
+            self.pending = history.begin(job.name, job.library_categories[category]["library"], category)
+        self.movies = []
+        # show_id -> [episode_count, first episode, {season: episode numbers}];
+        # the first episode of each show is kept to look the show up by
+        self.shows = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if error is not None and self.pending is not None:
+            self.pending.discard()
+
+    def add(self, item):
+        """Adds a RecentItem, unless it was already announced"""
+        if state.is_announced(self.state_key, item.item_id):
+            return
+        self.newest.add(item)
+
+        if self.media_type == "movie":
+            self.movies.append((item.guids, clean_year(item.title, item.year)))
+            if self.pending is not None:
+                self.pending.add("movie", item.item_id, item.title, item.year, added_at=item.added_at)
+            return
+
+        if self.pending is not None:
+            self.pending.add("episode", item.item_id, item.title, item.year, item.show_id,
+                             item.show_title or "Unknown", item.season, item.episode, item.added_at)
+        if item.show_id is None:
+            return
+        if item.show_id not in self.shows:
+            self.shows[item.show_id] = [0, item, {}]
+        show = self.shows[item.show_id]
+        show[0] += 1
+        if item.season is not None and item.episode is not None:
+            show[2].setdefault(item.season, set()).add(item.episode)
+
+    def show_episodes(self):
+        """The first new episode of each show, to look the shows up by"""
+        return [show[1] for show in self.shows.values()]
+
+    def result(self, show_titles=None):
+        """
+        Returns the library's (title, description, count, announced,
+        movies, pending) tuple, where announced lists (item_id, added_at)
+        pairs for the state store, movies lists the (guids, text) of every
+        movie for merge_duplicates (None for shows) and pending is the
+        history.PendingBatch the items are staged in until they are queued
+        (None if the history is disabled), or None if nothing is new.
+
+        Arguments:
+        show_titles -- for episodes, dict mapping show_id to a (title, year)
+                       tuple, see lookup_show_titles
+        """
+        if self.media_type == "movie":
+            if not self.movies:
+                return self.discard()
+            title, media_str = movie_embed(self.job, self.category, [text for _, text in self.movies])
+            return title, media_str, len(self.movies), self.newest.pairs(), self.movies, self.pending
+
+        if not self.newest.item_ids:
+            return self.discard()
+
+        # Episodes whose show could not be looked up fall back to the show
+        # title carried on the episode itself. Shows that end up with the
+        # same title are listed once.
+        show_titles = show_titles or {}
+        counted_shows = {}
+        for show_id, (episode_count, episode, seasons) in self.shows.items():
+            show_title, show_year = show_titles.get(
+                show_id, (episode.show_title or "Unknown", None))
+            counted = counted_shows.setdefault(clean_year(show_title, show_year), [0, {}])
+            counted[0] += episode_count
+            for season, numbers in seasons.items():
+                counted[1].setdefault(season, set()).update(numbers)
+        if self.pending is not None:
+            self.pending.set_shows({show_id: show for show_id, show in show_titles.items()
+                                    if show_id in self.shows})
+
+        title, media_str, total_episodes = show_embed(self.job, self.category, counted_shows)
+        return title, media_str, total_episodes, self.newest.pairs(), None, self.pending
+
+    def discard(self):
+        """Drops the staged items when nothing is new; returns None"""
+        if self.pending is not None:
+            self.pending.discard()
+        return None
+
+
+def format_library(job, category, media_type, items, timings=None):
+    """
+    Formats the new media of a single library for an embed, see
+    LibraryDigest.result for the return value.
+
+    Items are consumed one at a time and episodes are folded into per-show
+    counts as they arrive, so a bulk import is never held in memory.
+
+    Arguments:
+    job -- the Job the library belongs to
+    category -- key of the library in job.library_categories
+    media_type -- "movie" or "episode", see media_type_of
+    items -- iterable of RecentItem records
+    timings -- optional dict; the seconds spent looking up shows are added
+               to its "metadata" key
+    """
+    with LibraryDigest(job, category, media_type) as digest:
+        for item in items:
+            digest.add(item)
+
+        lookup_started = time.perf_counter()
+        show_titles = lookup_show_titles(job.source, digest.show_episodes())
+        if timings is not None:
+            timings["metadata"] = timings.get("metadata", 0.0) + time.perf_counter() - lookup_started
+        return digest.result(show_titles)
+
+
+def show_embed(job, category, counted_shows):
+    """
+    Returns the title, description and number of episodes of a show
+    library's embed.
+
+    Arguments:
+    job -- the Job the library belongs to
+    category -- key of the library in job.library_categories
+    counted_shows -- dict mapping each show's text, e.g. "Severance
+                     (2022)", to its [episode_count, seasons], where
+                     seasons maps season numbers to sets of episode numbers
+    """
+    settings = job.library_categories[category]
+    bullet_local = job.bullet + " "
+    show_list = []
+    total_episodes = 0
+
+    for counted_show, (episode_count, seasons) in counted_shows.items():
+        total_episodes += episode_count
+        episodes_counted = "episode"
+        if episode_count > 1:
+            episodes_counted += "s"
+        line = bullet_local + counted_show
+        if job.show_individual_episodes:
+            line += f" - *{episode_count} {episodes_counted}*"
+        if job.show_episode_numbers and seasons:
+            ranges = episode_ranges(seasons)
+            line += f" ({ranges})" if job.show_individual_episodes else f" - {ranges}"
+        show_list.append(line)
+    show_list.sort()
+    total_shows = len(show_list)
+    media_str = "\n".join(show_list)
+
+    # Build title
+    show_type = "Show"
+    episode_type = "Episode"
+    if total_shows > 1:
+        episode_type += "s"
+        show_type += "s"
+    elif total_episodes > 1:
+        show_type += "s"
+
+    if job.show_total_episodes:
+        title = (f"{total_shows} {show_type} /"
+                 f" {total_episodes} {episode_type}"
+                 f" {settings['emote']}")
+    else:
+        title = f"{total_shows} {show_type} {settings['emote']}"
+    return title, media_str, total_episodes
+
+
+def movie_embed(job, category, lines):
+    """Returns the title and description of a movie library's embed"""
+    bullet_local = job.bullet + " "
+    media_str = bullet_local + ("\n" + bullet_local).join(lines)
+    media_type = "Movie" if len(lines) == 1 else "Movies"
+    return f"{len(lines)} {media_type} {job.library_categories[category]['emote']}", media_str
+
+
+def merge_duplicates(job, results):
+    """
+    Lists every movie once across the job's libraries. A movie added to
+    several libraries, recognised by a shared external ID, is listed only
+    in the first of them (in the configured order) with the badge of every
+    library it was added to, e.g. "Dune (2021) — 1080p · 4K · Remux". A
+    library whose movies were all listed elsewhere gets no embed, but its
+    announced items are kept so its state still advances.
+
+    Arguments:
+    job -- the Job the results belong to
+    results -- dict mapping category to a format_library result or None
+
+    Returns the results with the affected embeds rebuilt.
+    """
+    # category -> [text, badges] of each movie it lists, and external ID ->
+    # the same [text, badges] list, so later libraries can add their badge
+    lines = {}
+    listed = {}
+    merged = False
+    for category in job.enabled_categories():
+        result = results.get(category)
+        if result is None or result[4] is None:
+            continue
+        badge = job.library_categories[category]["badge"]
+        lines[category] = []
+        for guids, text in result[4]:
+            line = next((listed[guid] for guid in guids if guid in listed), None)
+            if line is None:
+                line = [text, [badge]]
+                lines[category].append(line)
+            else:
+                merged = True
+                if badge not in line[1]:
+                    line[1].append(badge)
+            for guid in guids:
+                listed.setdefault(guid, line)
+    if not merged:
+        return results
+
+    results = dict(results)
+    for category, category_lines in lines.items():
+        texts = [text + (f" — {' · '.join(badges)}" if len(badges) > 1 else "")
+                 for text, badges in category_lines]
+        title, media_str = movie_embed(job, category, texts) if texts else (None, None)
+        results[category] = (title, media_str, len(texts)) + results[category][3:]
+    return results
+
+
+def collect_library(job, category, window):
+    """
+    Queries a single library and formats the media added within the window
+    for an embed. See format_library for the return value. Safe to call
+    from worker threads. The time spent waiting for the server, looking up
+    shows and formatting is recorded separately.
+    """
+    labels = {"job": job.name, "library": job.library_categories[category]["library"]}
+    timings = {}
+    started = time.perf_counter()
+    media_type = library_media_type(job, category)
+    items = TimedIterator(query_library(job, category, media_type, window))
+    try:
+        return format_library(job, category, media_type, items, timings)
+    finally:
+        elapsed = time.perf_counter() - started
+        metadata = timings.get("metadata", 0.0)
+        metrics.observe("library_phase_seconds", items.seconds, phase="query", **labels)
+        metrics.observe("library_phase_seconds", metadata, phase="metadata", **labels)
+        metrics.observe("library_phase_seconds", elapsed - items.seconds - metadata, phase="format", **labels)
+
+
+def queue_digests(job, results, period_text, window_end=None):
+    """
+    Builds the messages of each library group from the per-library
+    results, in the configured group and category order, and queues them
+    in the outbox. Once a group's messages are in the outbox its libraries
+    have their watermark advanced; messages that fail to send are retried
+    from the outbox rather than queried again.
+
+    Movies added to several libraries are listed once, see
+    merge_duplicates. The items of every queued group are recorded in the
+    history.
+
+    Arguments:
+    job -- the Job the results belong to
+    results -- dict mapping category to a format_library result or None
+    period_text -- text describing the period covered, e.g. "4 hours"
+    window_end -- optional end of the window covered, recorded as the job's
+                  last announced window
     """
-    logger.info("Starting update")
-    start_time = int(time.time())
-    total_webhooks = 0
     library_summary = {}
+    if job.merge_duplicates:
+        results = merge_duplicates(job, results)
+
+    # Process each group separately
+    for group_name, group_config in job.library_groups.items():
+        webhook_embeds = []
+        group_announced = {}
+        group_pending = {}
+        group_title = f"_ _\n**{job.message_titles[group_name]} {period_text}:**"
+
+        # Process each category in the current group
+        for category in group_config["libraries"]:
+            settings = job.library_categories[category]
+            result = results.get(category)
+            if settings["skip"] or result is None:
+                continue
+
+            title, media_str, total, announced, _, pending = result
+            library_summary[settings['library']] = total
+            metrics.inc("items_announced_total", total, job=job.name, library=settings["library"])
+            group_announced[job.state_key(category)] = announced
+            if pending is not None:
+                group_pending[category] = pending
+            # No embed if all of its movies are listed in another library
+            if title is not None:
+                create_embeds(title, media_str, settings["colour"], webhook_embeds)
+
+        # Splits the embeds over as few messages as discord's limits allow.
+        # The group title goes on the first message only.
+        messages = pack_embeds(webhook_embeds)
+
+        # Adds thumbnail image to embeds if specified
+        [embed.set_thumbnail(job.embed_thumbnail) for message in messages for embed in message]
+
+        # Queue the messages for this group, if there are embeds. The
+        # libraries are advanced even without any, as their movies may have
+        # been listed in another group.
+        for i, message_embeds in enumerate(messages):
+            outbox.add(job.name, job.webhook_url, group_title if i == 0 else "",
+                       [embed.to_dict() for embed in message_embeds])
+        for state_key, announced in group_announced.items():
+            state.advance(state_key, announced)
+
+        try:
+            for pending in group_pending.values():
+                pending.commit()
+        except sqlite3.Error as err:
+            logger.error(f"Recording history failed for {group_name}: {str(err)}")
+
+    if window_end is not None:
+        state.set_window(job.name, window_end.timestamp())
+    try:
+        state.save()
+    except OSError as err:
+        logger.error(f"Saving state failed: {str(err)}")
+
+    # Log summary
+    for library, count in library_summary.items():
+        logger.info(f"{library}: {count}")
+
+
+def send_digests(job, results, period_text, window_end=None):
+    """
+    Queues the job's digests (see queue_digests) and sends what is due in
+    the outbox. Returns the number of webhooks sent.
+    """
+    queue_digests(job, results, period_text, window_end)
+    total_webhooks = deliver_outbox()
+    logger.info(f"Webhooks sent for {job.name}: {total_webhooks}")
+    return total_webhooks
+
 
-    # Formatting strings from user variables section
-    bullet_local = bullet + " "
-    max_length_exceeded_msg_local = f"\n\n**{max_length_exceeded_msg}**"
-    # Checks whether the lookback period should be specified
-    # in plural and makes the message text look more natural.
+@contextmanager
+def sending(entry):
+    """Times sending a message from the outbox and counts whether it was delivered"""
+    try:
+        with metrics.timer("send_seconds", job=entry["job"]):
+            yield
+    except Exception:
+        metrics.inc("webhook_failures_total", job=entry["job"])
+        raise
+    metrics.inc("webhooks_sent_total", job=entry["job"])
+
+
+def send_entry(entry):
+    """Sends a message from the outbox. Raises if it was not delivered."""
+    with sending(entry):
+        dispatcher.send(entry["url"], entry["content"], entry["embeds"])
+
+
+def deliver_outbox():
+    """
+    Sends the messages in the outbox that are due. Returns the number of
+    messages delivered.
+    """
+    try:
+        delivered = outbox.deliver(send_entry)
+    except OSError as err:
+        logger.error(f"Saving outbox failed: {str(err)}")
+        return 0
+    metrics.set("outbox_pending", outbox.pending())
+    return delivered
+
+
+def outbox_delay():
+    """Returns the seconds until the outbox's next retry is due, between 1 and 60"""
+    next_due = outbox.next_due()
+    delay = 60 if next_due is None else next_due - time.time()
+    return min(max(delay, 1), 60)
+
+
+def run_outbox():
+    """
+    Retries undelivered webhook messages in the background, waking up when
+    the next retry is due (or at least every minute). Never returns.
+    """
+    while True:
+        time.sleep(outbox_delay())
+        if outbox.next_due() is not None:
+            deliver_outbox()
+
+
+def describe_period(period):
+    """
+    Turns a period string such as "4h" into text for the webhook message
+    (e.g. "4 hours"), using the singular for a value of 1.
+    """
     period_dict = {
         "m": "minute",
         "h": "hour",
         "d": "day",
         "w": "week",
     }
+    if period[:-1] == "1":
+        return period_dict[period[-1]]
+    return f"{period[:-1]} {period_dict[period[-1]]}s"
 
-    # Builds the webhook message that includes the max age of the new media
-    if lookback_period[:-1] == "1":
-        lookback_text = period_dict[lookback_period[-1]]
-    else:
-        lookback_text = (f"{lookback_period[:-1]}"
-                         f" {period_dict[lookback_period[-1]]}s")
 
-    logger.info(f"Looking back {lookback_text}")
+def describe_window(start, end):
+    """
+    Describes the length of a window for the webhook message, in the
+    largest unit that divides it evenly (e.g. "4 hours", "90 minutes"), or
+    in whole hours if it is longer than two hours and uneven.
+    """
+    minutes = max(round((end - start).total_seconds() / 60), 1)
+    for unit, length in (("w", 10080), ("d", 1440), ("h", 60)):
+        if minutes % length == 0:
+            return describe_period(f"{minutes // length}{unit}")
+    if minutes > 120:
+        return describe_period(f"{round(minutes / 60)}h")
+    return describe_period(f"{minutes}m")
+
+
+def log_show_cache():
+    """Logs the show cache hits and misses since the last call and saves it"""
+    hits, misses = show_cache.take_stats()
+    metrics.inc("show_cache_hits_total", hits)
+    metrics.inc("show_cache_misses_total", misses)
+    logger.info(f"Show cache: {hits} hits, {misses} misses")
+    try:
+        show_cache.save()
+    except OSError as err:
+        logger.error(f"Saving show cache failed: {str(err)}")
+
 
-    # Initialize platform-specific connection
-    if platform == "plex":
+def connect_jobs(jobs):
+    """
+    Connects the media server of every job, once per server, returning the
+    jobs whose server connected successfully.
+    """
+    connected_sources = {}
+    for source in dict.fromkeys(job.source for job in jobs):
+        platform_name = source.platform.capitalize()
         try:
-            plex = PlexServer(plex_url, plex_token)
-            webhook = Webhook(webhook_url)
-            logger.info("Connected to Plex")
+            with metrics.timer("connect_seconds", server=source.name):
+                source.connect()
+            logger.info(f"Connected to {platform_name} ({source.name})")
+            connected_sources[source] = True
         except Exception as e:
-            logger.error(f"Plex connection failed: {str(e)}")
-            return
-    else:  # jellyfin
+            metrics.inc("connect_failures_total", server=source.name)
+            logger.error(f"{platform_name} connection failed ({source.name}): {str(e)}")
+    return [job for job in jobs if job.source in connected_sources]
+
+
+def finish_run(snapshot, started_at, mode):
+    """
+    Records the run's duration and, if enabled, writes what it did to
+    last_run.json in data_dir.
+
+    Arguments:
+    snapshot -- metrics.snapshot() taken when the run started
+    started_at -- time.time() when the run started
+    mode -- "update", "webhook", "alert" or "backfill"
+    """
+    duration = time.time() - started_at
+    metrics.inc("runs_total", mode=mode)
+    metrics.set("last_run_duration_seconds", round(duration, 3), mode=mode)
+    metrics.set("last_run_timestamp_seconds", int(started_at), mode=mode)
+    logger.info(f"Run took {duration:.1f}s")
+
+    if metrics_options["run_report"]:
+        report = {
+            "mode": mode,
+            "started": datetime.fromtimestamp(started_at).isoformat(timespec="seconds"),
+            "duration_seconds": round(duration, 3)
+        }
+        report.update(metrics.report(snapshot))
         try:
-            jellyfin = JellyfinClient(jellyfin_url, jellyfin_api_key)
-            webhook = Webhook(webhook_url)
-            logger.info("Connected to Jellyfin")
-        except Exception as e:
-            logger.error(f"Jellyfin connection failed: {str(e)}")
-            return
+            atomic_write_json(data_dir / "last_run.json", report, indent=2)
+        except OSError as err:
+            logger.error(f"Writing run report failed: {str(err)}")
+
+
+def run_update(jobs=None, until=None):
+    """
+    Main function that runs the update process. The libraries of all the
+    given jobs (every configured job by default) that have a window due
+    are scanned concurrently. A job's window is only marked as announced
+    if all of its libraries were queried.
+
+    Arguments:
+    jobs -- list of Jobs, or None for every configured job
+    until -- optional datetime to announce media up to, instead of the end
+             of each job's newest complete window (see job_window)
+    """
+    windows = due_windows(jobs or configured_jobs, until)
+    if not windows:
+        return
+    logger.info("Starting update")
+    start_time = int(time.time())
+    started_at = time.time()
+    snapshot = metrics.snapshot()
+
+    # Initialize platform-specific connections
+    jobs = connect_jobs(list(windows))
+    if not jobs:
+        finish_run(snapshot, started_at, "update")
+        return
+    for job in jobs:
+        start, end = windows[job]
+        logger.info(f"{job.name}: announcing {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}")
 
     logger.info("Collecting Recently Added Media")
 
-    # Process each group separately
-    for group_name, group_config in script_config["library_groups"].items():
-        webhook_embeds = []
-        group_title = f"_ _\n**{script_config['message_options']['titles'][group_name]} {lookback_text}:**"
+    # Every enabled library is queried once, concurrently; embeds are still
+    # assembled in the configured group and category order afterwards. Each
+    # job has its own workers, so it queries at most max_concurrency of its
+    # libraries at a time, as with the async engine.
+    with ExitStack() as stack:
+        executors = {job: stack.enter_context(ThreadPoolExecutor(max_workers=job.max_concurrency))
+                     for job in jobs}
+        futures = {(job, category): executors[job].submit(collect_library, job, category, windows[job])
+                   for job in jobs
+                   for category in job.enabled_categories()}
+    results = {job: {} for job in jobs}
+    failed = set()
+    for (job, category), future in futures.items():
+        try:
+            results[job][category] = future.result()
+        except Exception as e:
+            failed.add(job)
+            logger.error(f"Error in {job.library_categories[category]['library']}: {str(e)}")
+
+    log_show_cache()
+
+    for job in jobs:
+        # Builds the webhook message that includes the length of the window
+        start, end = windows[job]
+        send_digests(job, results[job], describe_window(start, end), None if job in failed else end)
+
+        # Ping uptime status monitor if specified
+        if job.uptime_status:
+            try:
+                http_session.get(f"{job.uptime_status}{int(time.time()) - start_time}")
+            except Exception as err:
+                logger.error(f"Uptime ping failed: {str(err)}")
+
+    finish_run(snapshot, started_at, "update")
 
-        # Process each category in the current group
-        for category in group_config["libraries"]:
-            settings = library_categories[category]
-            if settings["skip"]:
-                continue
 
+def process_events(events, period, mode="webhook"):
+    """
+    Sends digests for media reported by webhook events or Plex alerts,
+    without polling the libraries. Called with each batch of buffered
+    events.
+
+    Arguments:
+    events -- list of (path, payload) tuples from the listener or a PlexAlertTracker
+    period -- debounce period the events were collected over, e.g. "5m"
+    mode -- "webhook" or "alert", for the run report
+    """
+    started_at = time.time()
+    snapshot = metrics.snapshot()
+    jobs = connect_jobs([job for job in configured_jobs
+                         if any(path == job.webhook_path for path, event in events)])
+    for job in jobs:
+        job_events = [event for path, event in events if path == job.webhook_path]
+        logger.info(f"Processing {len(job_events)} {mode} events for {job.name}")
+
+        results = {}
+        for category in job.enabled_categories():
+            settings = job.library_categories[category]
             try:
-                is_movie = "movies" in category
-
-                if platform == "plex":
-                    library = plex.library.section(settings["library"])
-
-                    if is_movie:
-                        # Process movies
-                        new_media = library.search(filters={"addedAt>>": lookback_period})
-                        if not new_media:
-                            continue
-
-                        media_str = bullet_local
-                        new_media_formatted = [clean_year(item) for item in new_media]
-                        total_items = len(new_media_formatted)
-                        media_str += ("\n" + bullet_local).join(new_media_formatted)
-                        library_summary[settings['library']] = total_items
-
-                        # Build title
-                        media_type = "Movie"
-                        if total_items != 1:
-                            media_type += "s"
-                        title = f"{total_items} {media_type} {settings['emote']}"
-
-                    else:
-                        # Process TV shows
-                        new_eps = library.searchEpisodes(filters={"addedAt>>": lookback_period})
-                        if not new_eps:
-                            continue
-
-                        new_shows = []
-                        for episode in new_eps:
-                            new_shows.append(clean_year(
-                                plex.fetchItem(episode.grandparentRatingKey)))
-
-                        counted_shows = Counter(new_shows)
-                        show_list = []
-                        total_episodes = 0
-
-                        for counted_show in counted_shows:
-                            episode_count = counted_shows[counted_show]
-                            total_episodes += episode_count
-                            episodes_counted = "episode"
-                            if episode_count > 1:
-                                episodes_counted += "s"
-                            if show_individual_episodes:
-                                show_list.append(f"{bullet_local}{counted_show} -"
-                                               f" *{episode_count} {episodes_counted}*")
-                            else:
-                                show_list.append(bullet_local + counted_show)
-                        show_list.sort()
-                        total_shows = len(show_list)
-                        media_str = "\n".join(show_list)
-                        library_summary[settings['library']] = total_episodes
-
-                        # Build title
-                        show_type = "Show"
-                        episode_type = "Episode"
-                        if total_shows > 1:
-                            episode_type += "s"
-                            show_type += "s"
-                        elif total_episodes > 1:
-                            show_type += "s"
-
-                        if show_total_episodes:
-                            title = (f"{total_shows} {show_type} /"
-                                    f" {total_episodes} {episode_type}"
-                                    f" {settings['emote']}")
-                        else:
-                            title = f"{total_shows} {show_type} {settings['emote']}"
-
-                else:  # jellyfin
-                    library_id = settings["library"]
-                    
-                    # Calculate the date threshold for Jellyfin
-                    date_threshold = parse_lookback_period(lookback_period)
-                    date_threshold_str = date_threshold.strftime("%Y-%m-%d")
-
-                    if is_movie:
-                        # Process movies
-                        item_type = "Movie"
-                        new_media_data = jellyfin.get_library_items(library_id, item_type, date_threshold_str)
-                        new_media = new_media_data.get('Items', [])
-                        
-                        if not new_media:
-                            continue
-
-                        media_str = bullet_local
-                        new_media_formatted = [clean_year(item) for item in new_media]
-                        total_items = len(new_media_formatted)
-                        media_str += ("\n" + bullet_local).join(new_media_formatted)
-                        library_summary[settings['library']] = total_items
-
-                        # Build title
-                        media_type = "Movie"
-                        if total_items != 1:
-                            media_type += "s"
-                        title = f"{total_items} {media_type} {settings['emote']}"
-
-                    else:
-                        # Process TV shows
-                        item_type = "Episode"
-                        new_eps_data = jellyfin.get_library_items(library_id, item_type, date_threshold_str)
-                        new_eps = new_eps_data.get('Items', [])
-                        
-                        if not new_eps:
-                            continue
-
-                        new_shows = []
-                        for episode in new_eps:
-                            # Get the series information
-                            series_id = episode.get('SeriesId')
-                            if series_id:
-                                series = jellyfin.get_item(series_id)
-                                new_shows.append(clean_year(series))
-
-                        counted_shows = Counter(new_shows)
-                        show_list = []
-                        total_episodes = 0
-
-                        for counted_show in counted_shows:
-                            episode_count = counted_shows[counted_show]
-                            total_episodes += episode_count
-                            episodes_counted = "episode"
-                            if episode_count > 1:
-                                episodes_counted += "s"
-                            if show_individual_episodes:
-                                show_list.append(f"{bullet_local}{counted_show} -"
-                                               f" *{episode_count} {episodes_counted}*")
-                            else:
-                                show_list.append(bullet_local + counted_show)
-                        show_list.sort()
-                        total_shows = len(show_list)
-                        media_str = "\n".join(show_list)
-                        library_summary[settings['library']] = total_episodes
-
-                        # Build title
-                        show_type = "Show"
-                        episode_type = "Episode"
-                        if total_shows > 1:
-                            episode_type += "s"
-                            show_type += "s"
-                        elif total_episodes > 1:
-                            show_type += "s"
-
-                        if show_total_episodes:
-                            title = (f"{total_shows} {show_type} /"
-                                    f" {total_episodes} {episode_type}"
-                                    f" {settings['emote']}")
-                        else:
-                            title = f"{total_shows} {show_type} {settings['emote']}"
-
-                # Create embed for this category
-                create_embeds(title, media_str, settings["colour"], message_max_length, webhook_embeds)
+                media_type = library_media_type(job, category)
+                with metrics.timer("library_phase_seconds", phase="query", job=job.name, library=settings["library"]):
+                    items = job.source.event_items(settings["library"], media_type, job_events)
+                if items:
+                    results[category] = format_library(job, category, media_type, items)
             except Exception as e:
                 logger.error(f"Error in {settings['library']}: {str(e)}")
+
+        send_digests(job, results, describe_period(period))
+    log_show_cache()
+    finish_run(snapshot, started_at, mode)
+
+
+def named_jobs(job_names):
+    """
+    Returns the configured jobs with the given names, or every job if no
+    names are given. Logs an error and returns None if a name is unknown.
+    """
+    jobs = [job for job in configured_jobs if not job_names or job.name in job_names]
+    unknown = set(job_names or []) - {job.name for job in jobs}
+    if unknown:
+        logger.error(f"Unknown jobs: {', '.join(sorted(unknown))}")
+        return None
+    return jobs
+
+
+def backfill_windows(start, end, length):
+    """Splits [start, end) into windows of the given length; the last may be shorter"""
+    windows = []
+    while start < end:
+        windows.append((start, min(start + length, end)))
+        start += length
+    return windows
+
+
+def collect_window(job, window):
+    """
+    Queries every enabled library of a job for the media added within a
+    window, regardless of the libraries' watermarks. Returns a (results,
+    failed) tuple, where results maps category to a format_library result
+    and failed lists the libraries that could not be queried. Safe to call
+    from worker threads.
+    """
+    since, until = window
+    results = {}
+    failed = []
+    for category in job.enabled_categories():
+        settings = job.library_categories[category]
+        try:
+            media_type = library_media_type(job, category)
+            items = TimedIterator(job.source.recent_items(settings["library"], media_type,
+                                                          query_start(since), until))
+            results[category] = format_library(job, category, media_type,
+                                               (item for item in items if in_window(item, since, until)))
+            metrics.observe("library_phase_seconds", items.seconds, phase="query",
+                            job=job.name, library=settings["library"])
+        except Exception as e:
+            failed.append(settings["library"])
+            logger.error(f"Error in {settings['library']} ({since:%Y-%m-%d %H:%M}): {str(e)}")
+    return results, failed
+
+
+def discard_results(results):
+    """Drops the history staged for the results of a window that is not sent, see collect_window"""
+    for result in results.values():
+        if result is not None and result[5] is not None:
+            result[5].discard()
+
+
+def run_backfill(start, end, length, job_names=None):
+    """
+    Announces the media added between start and end, one digest per window
+    of the given length, oldest first. A job's windows are queried
+    max_concurrency at a time, ahead of the one being sent, so only that
+    many windows are held in memory however long the range is. Every
+    library's watermark is advanced as in a normal run.
+
+    A window in which a library could not be queried is queried once more.
+    If that fails too, or the job's server cannot be connected to, the
+    window is not sent, and the windows to rerun are logged at the end.
+    Returns True if every window was sent.
+
+    Arguments:
+    start -- datetime to backfill from
+    end -- datetime to backfill up to
+    length -- length of each window, in the lookback_period format
+    job_names -- optional list of the jobs to backfill; all jobs if empty
+    """
+    jobs = named_jobs(job_names)
+    if jobs is None:
+        return False
+    windows = backfill_windows(start, end, parse_period(length))
+    logger.info(f"Backfilling {len(windows)} windows from {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}")
+    started_at = time.time()
+    snapshot = metrics.snapshot()
+
+    # (job, start, end, libraries) of the windows that were not sent
+    failures = []
+    connected = connect_jobs(jobs)
+    for job in jobs:
+        if job not in connected:
+            failures.append((job, start, end, [f"server {job.source.name}"]))
+    for job in connected:
+        with ThreadPoolExecutor(max_workers=job.max_concurrency) as executor:
+            upcoming = iter(windows)
+            pending = deque((window, executor.submit(collect_window, job, window))
+                            for window in itertools.islice(upcoming, job.max_concurrency))
+            while pending:
+                (since, until), future = pending.popleft()
+                results, failed = future.result()
+                # Keep the workers busy while this window is sent
+                for window in itertools.islice(upcoming, 1):
+                    pending.append((window, executor.submit(collect_window, job, window)))
+                if failed:
+                    logger.warning(f"{job.name}: retrying {since:%Y-%m-%d %H:%M} to {until:%Y-%m-%d %H:%M}")
+                    discard_results(results)
+                    results, failed = collect_window(job, (since, until))
+                if failed:
+                    discard_results(results)
+                    failures.append((job, since, until, failed))
+                    continue
+                send_digests(job, results, f"{describe_window(since, until)} up to {until:%Y-%m-%d %H:%M}")
+
+    log_show_cache()
+    finish_run(snapshot, started_at, "backfill")
+
+    if failures:
+        logger.error(f"Backfill incomplete: {len(failures)} windows were not sent. To rerun them:")
+        for job, since, until, failed in failures:
+            logger.error(f"  {', '.join(failed)}: python main.py backfill --job {job.name}"
+                         f' --from "{since:%Y-%m-%d %H:%M}" --to "{until:%Y-%m-%d %H:%M}" --window {length}')
+    return not failures
+
+
+def rollup_start(kind, moment):
+    """Returns the start of the daily, weekly or monthly rollup period containing moment"""
+    day = datetime(moment.year, moment.month, moment.day)
+    if kind == "daily":
+        return day
+    if kind == "weekly":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_rollup_start(kind, start):
+    """Returns the start of the rollup period following the one that starts at start"""
+    if kind == "daily":
+        return start + timedelta(days=1)
+    if kind == "weekly":
+        return start + timedelta(weeks=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def due_rollups(jobs, now=None):
+    """
+    Returns the rollups that are due as (job, kind, start, end) tuples. A
+    rollup is due once its period is over and the job's windows have been
+    announced up to its end, so it lists everything added during the
+    period; periods missed while the app was down are each sent, going
+    back at most max_catch_up. A job's first rollup of a kind covers the
+    first full period after it was enabled.
+
+    Arguments:
+    jobs -- list of Jobs
+    now -- optional datetime to use as the current time
+    """
+    now = now or datetime.now()
+    earliest = now - parse_period(scheduler_options["max_catch_up"])
+    due = []
+    for job in jobs:
+        announced = state.get_window(job.name)
+        for kind in job.rollups:
+            key = f"{job.name}:rollup:{kind}"
+            end = rollup_start(kind, now)
+            last = state.get_window(key)
+            if last is None:
+                state.set_window(key, end.timestamp())
+                continue
+            if announced is None:
                 continue
+            end = min(end, rollup_start(kind, datetime.fromtimestamp(announced)))
+            start = max(datetime.fromtimestamp(last), rollup_start(kind, earliest))
+            while start < end:
+                due.append((job, kind, start, next_rollup_start(kind, start)))
+                start = due[-1][3]
+    return due
+
+
+def next_rollup_end(jobs):
+    """Returns the datetime the next rollup of any of the jobs is due, or None if they have none"""
+    now = datetime.now()
+    return min((next_rollup_start(kind, rollup_start(kind, now)) for job in jobs for kind in job.rollups),
+               default=None)
+
+
+def queue_rollup(job, kind, start, end):
+    """
+    Queues a job's rollup of the media it announced that was added between
+    start and end.
+    The rollup is built from the history alone, with each movie and show
+    listed once: a movie added to several libraries gets the badge of
+    each, and an episode added to several libraries is counted once.
+    Nothing is queued if nothing was announced. Raises sqlite3.Error if
+    the history could not be read.
+
+    Arguments:
+    job -- the Job to send the rollup for
+    kind -- "daily", "weekly" or "monthly"
+    start -- datetime the period starts
+    end -- datetime the period ends
+    """
+    movies = history.movies(job.name, start.timestamp(), end.timestamp())
+    shows = history.shows(job.name, start.timestamp(), end.timestamp())
+    webhook_embeds = []
+
+    # Each embed takes the colour and emote of the first library, in the
+    # configured order, that the movies or shows were added to
+    used = set().union(*(movie[2] for movie in movies))
+    category = next((category for category in job.library_categories if category in used), None)
+    if category is not None:
+        lines = []
+        for title, year, categories in movies:
+            badges = [settings["badge"] for category_key, settings in job.library_categories.items()
+                      if category_key in categories]
+            lines.append(clean_year(title, year) + (f" — {' · '.join(badges)}" if len(badges) > 1 else ""))
+        title, media_str = movie_embed(job, category, lines)
+        create_embeds(title, media_str, job.library_categories[category]["colour"], webhook_embeds)
+
+    used = set().union(*(show[4] for show in shows))
+    category = next((category for category in job.library_categories if category in used), None)
+    if category is not None:
+        counted_shows = {}
+        for title, year, episode_count, seasons, _ in shows:
+            counted = counted_shows.setdefault(clean_year(title, year), [0, {}])
+            counted[0] += episode_count
+            for season, numbers in seasons.items():
+                counted[1].setdefault(season, set()).update(numbers)
+        title, media_str, _ = show_embed(job, category, counted_shows)
+        create_embeds(title, media_str, job.library_categories[category]["colour"], webhook_embeds)
+
+    messages = pack_embeds(webhook_embeds)
+    [embed.set_thumbnail(job.embed_thumbnail) for message in messages for embed in message]
+    heading = f"_ _\n**{rollup_titles[kind].format(start=start)}:**"
+    for i, message_embeds in enumerate(messages):
+        outbox.add(job.name, job.webhook_url, heading if i == 0 else "",
+                   [embed.to_dict() for embed in message_embeds])
+    logger.info(f"{job.name}: {kind} rollup from {start:%Y-%m-%d}, {len(movies)} movies, {len(shows)} shows")
+
+
+def queue_rollups(jobs=None):
+    """
+    Queues every rollup that is due (see due_rollups) and records it as
+    sent. If a rollup could not be built, it and the later rollups of the
+    same kind are retried at the next period's end. Returns
+    the number of rollups queued.
+    """
+    queued = 0
+    failed = set()
+    for job, kind, start, end in due_rollups(jobs or configured_jobs):
+        if (job, kind) in failed:
+            continue
+        try:
+            queue_rollup(job, kind, start, end)
+        except sqlite3.Error as err:
+            logger.error(f"Reading history failed for {job.name}: {str(err)}")
+            failed.add((job, kind))
+            continue
+        state.set_window(f"{job.name}:rollup:{kind}", end.timestamp())
+        queued += 1
+    try:
+        state.save()
+    except OSError as err:
+        logger.error(f"Saving state failed: {str(err)}")
+    return queued
 
-        # Adds thumbnail image to embeds if specified
-        [embed.set_thumbnail(embed_thumbnail) for embed in webhook_embeds]
 
-        # Sending webhook for this group only if there are embeds
-        if webhook_embeds:
+def run_rollup(kind, day=None, job_names=None):
+    """
+    Sends a rollup right away, without recording it as sent.
+
+    Arguments:
+    kind -- "daily", "weekly" or "monthly"
+    day -- optional datetime within the period; the last full period by default
+    job_names -- optional list of the jobs to send it for; all jobs if empty
+    """
+    jobs = named_jobs(job_names)
+    if jobs is None:
+        return
+    if history is None:
+        logger.error("Rollups need history.enabled")
+        return
+    if day is None:
+        day = rollup_start(kind, datetime.now()) - timedelta(days=1)
+    start = rollup_start(kind, day)
+    for job in jobs:
+        queue_rollup(job, kind, start, next_rollup_start(kind, start))
+    logger.info(f"Webhooks sent: {deliver_outbox()}")
+
+
+async def lookup_show_titles_async(client, source, episodes):
+    """Like lookup_show_titles, looking up the missing shows with an async client"""
+    shows, missing = cached_show_titles(source, episodes)
+    if missing:
+        cache_show_titles(source, shows, await client.show_titles(missing))
+    return shows
+
+
+async def collect_library_async(job, category, window, client, semaphore):
+    """
+    Like collect_library, with the queries sent through an async client.
+    Items are folded into the digest page by page as they arrive. At most
+    job.max_concurrency libraries of a job are queried at once.
+    """
+    settings = job.library_categories[category]
+    labels = {"job": job.name, "library": settings["library"]}
+    async with semaphore:
+        started = time.perf_counter()
+        start, end = window
+        _, reported = await client.library(settings["library"])
+        media_type = media_type_of(category, reported)
+        threshold = library_threshold(job, category, start)
+        items = TimedAsyncIterator(client.recent_items(settings["library"], media_type, query_start(threshold)))
+        with LibraryDigest(job, category, media_type) as digest:
+            async for item in items:
+                if in_window(item, threshold, end):
+                    digest.add(item)
+
+            lookup_started = time.perf_counter()
+            show_titles = await lookup_show_titles_async(client, job.source, digest.show_episodes())
+            looked_up = time.perf_counter()
+            result = digest.result(show_titles)
+
+    metadata = looked_up - lookup_started
+    metrics.observe("library_phase_seconds", items.seconds, phase="query", **labels)
+    metrics.observe("library_phase_seconds", metadata, phase="metadata", **labels)
+    metrics.observe("library_phase_seconds", time.perf_counter() - started - items.seconds - metadata,
+                    phase="format", **labels)
+    return result
+
+
+async def deliver_outbox_async(http):
+    """Like deliver_outbox, sending the messages over an AsyncHTTP"""
+    async def send(entry):
+        with sending(entry):
+            await async_dispatcher.send(http, entry["url"], entry["content"], entry["embeds"])
+
+    try:
+        delivered = await outbox.deliver_async(send)
+    except OSError as err:
+        logger.error(f"Saving outbox failed: {str(err)}")
+        return 0
+    metrics.set("outbox_pending", outbox.pending())
+    return delivered
+
+
+async def run_update_async(jobs=None, until=None):
+    """
+    run_update for the async engine. Every enabled library of every job
+    with a window due is queried concurrently on the event loop, then the
+    digests of all jobs are sent, concurrently for different webhooks.
+    """
+    windows = due_windows(jobs or configured_jobs, until)
+    if not windows:
+        return
+    logger.info("Starting update")
+    started_at = time.time()
+    snapshot = metrics.snapshot()
+    jobs = list(windows)
+    for job in jobs:
+        start, end = windows[job]
+        logger.info(f"{job.name}: announcing {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}")
+
+    logger.info("Collecting Recently Added Media")
+    async with async_engine.AsyncHTTP.create_session(http_options) as session:
+        http = async_engine.AsyncHTTP(session, http_options, metrics)
+        clients = {source: async_engine.ASYNC_CLIENTS[source.platform](source, http)
+                   for source in dict.fromkeys(job.source for job in jobs)}
+        semaphores = {job: asyncio.Semaphore(job.max_concurrency) for job in jobs}
+
+        libraries = [(job, category) for job in jobs for category in job.enabled_categories()]
+        outcomes = await asyncio.gather(*(
+            collect_library_async(job, category, windows[job], clients[job.source], semaphores[job])
+            for job, category in libraries), return_exceptions=True)
+        results = {job: {} for job in jobs}
+        failed = set()
+        for (job, category), outcome in zip(libraries, outcomes):
+            if isinstance(outcome, Exception):
+                failed.add(job)
+                logger.error(f"Error in {job.library_categories[category]['library']}: {str(outcome)}")
+            else:
+                results[job][category] = outcome
+
+        log_show_cache()
+
+        for job in jobs:
+            start, end = windows[job]
+            queue_digests(job, results[job], describe_window(start, end), None if job in failed else end)
+        logger.info(f"Webhooks sent: {await deliver_outbox_async(http)}")
+
+        # Ping uptime status monitors if specified
+        async def ping(job):
             try:
-                webhook.send(group_title, embeds=webhook_embeds)
-                total_webhooks += 1
+                await http.request("GET", f"{job.uptime_status}{int(time.time() - started_at)}")
             except Exception as err:
-                logger.error(f"Webhook failed for {group_name}: {str(err)}")
+                logger.error(f"Uptime ping failed: {str(err)}")
+        await asyncio.gather(*(ping(job) for job in jobs if job.uptime_status))
 
-    # Log summary
-    for library, count in library_summary.items():
-        logger.info(f"{library}: {count}")
-    logger.info(f"Webhooks sent: {total_webhooks}")
+    finish_run(snapshot, started_at, "update")
 
-    # Ping uptime status monitor if specified
-    if uptime_status:
-        try:
-            requests.get(f"{uptime_status}{int(time.time()) - start_time}")
-        except Exception as err:
-            logger.error(f"Uptime ping failed: {str(err)}")
 
-    logger.info(f"Waiting for {lookback_text}")
+async def run_outbox_async():
+    """run_outbox for the async engine. Never returns."""
+    while True:
+        await asyncio.sleep(outbox_delay())
+        if outbox.next_due() is not None:
+            async with async_engine.AsyncHTTP.create_session(http_options) as session:
+                await deliver_outbox_async(async_engine.AsyncHTTP(session, http_options, metrics))
+
+
+def sleep_steps(moment):
+    """Yields the seconds to sleep for until the given datetime, at most max_sleep at a time"""
+    while True:
+        delay = (moment - datetime.now()).total_seconds()
+        if delay <= 0:
+            return
+        yield min(delay, max_sleep)
+
+
+def sleep_until(moment):
+    """Sleeps until the given datetime, waking at least every max_sleep seconds"""
+    for delay in sleep_steps(moment):
+        time.sleep(delay)
+
+
+def run_rollups(settle=0):
+    """
+    Sends the rollups of every job as their periods end, for the listener
+    and Plex alerts, which announce media as it is reported rather than in
+    windows. Once a period is over, and the media reported just before its
+    end has been flushed, the libraries are polled up to now (see
+    run_update) so the rollup covers everything added during the period.
+    Never returns.
+
+    Arguments:
+    settle -- seconds to wait after a period ends, e.g. the debounce period
+    """
+    while True:
+        if queue_rollups():
+            deliver_outbox()
+        sleep_until(next_rollup_end(configured_jobs) + timedelta(seconds=settle))
+        run_update(until=datetime.now())
+
 
 def run_scheduler():
     """
-    Function to run the scheduler in a separate thread
+    Runs the scheduled updates: announces the windows that are due and
+    queues the rollups they complete, then sleeps until the next window of
+    any job ends. Never returns.
     """
     while True:
-        schedule.run_pending()
-        time.sleep(1)
+        run_update()
+        if any(job.rollups for job in configured_jobs) and queue_rollups():
+            deliver_outbox()
+        next_run = next_window_end(configured_jobs)
+        logger.info(f"Next update at {next_run:%Y-%m-%d %H:%M}")
+        sleep_until(next_run)
+
+
+async def sleep_until_async(moment):
+    """sleep_until for the async engine"""
+    for delay in sleep_steps(moment):
+        await asyncio.sleep(delay)
+
+
+async def run_async():
+    """run_scheduler for the async engine. Never returns."""
+    async def run_windows():
+        while True:
+            await run_update_async()
+            if any(job.rollups for job in configured_jobs) and queue_rollups():
+                async with async_engine.AsyncHTTP.create_session(http_options) as session:
+                    await deliver_outbox_async(async_engine.AsyncHTTP(session, http_options, metrics))
+            next_run = next_window_end(configured_jobs)
+            logger.info(f"Next update at {next_run:%Y-%m-%d %H:%M}")
+            await sleep_until_async(next_run)
+
+    await asyncio.gather(run_outbox_async(), run_windows())
+
+
+def run_listener():
+    """
+    Receives webhooks from the media servers and sends a digest for every
+    debounce window's worth of new media. Blocks until interrupted.
+    """
+    parsers = {job.webhook_path: job.source.webhook_parser for job in configured_jobs}
+    debounce = parse_period(listener_options["debounce"]).total_seconds()
+    flush = functools.partial(process_events, period=listener_options["debounce"])
+    server = start_listener(listener_options["host"], listener_options["port"], parsers,
+                            EventBuffer(debounce, flush), listener_options["token"])
+    logger.info(f"Listening for webhooks on port {listener_options['port']}")
+    server.serve_forever()
+
+
+def start_alerts(source, jobs, buffer):
+    """
+    Connects to a Plex server and follows its notification stream for the
+    enabled libraries of the given jobs. Returns the listener thread.
+
+    Arguments:
+    source -- the jobs' PlexSource
+    jobs -- the jobs announcing the server's media
+    buffer -- EventBuffer new media is collected in
+    """
+    source.connect()
+    section_ids = set()
+    types = set()
+    for job in jobs:
+        for category in job.enabled_categories():
+            section_id, reported = source.library(job.library_categories[category]["library"])
+            section_ids.add(section_id)
+            types.add(plex_types[media_type_of(category, reported)])
+    tracker = PlexAlertTracker(jobs[0].webhook_path, section_ids, types, buffer)
+
+    def log_error(err):
+        logger.error(f"Plex notification stream error ({source.name}): {str(err)}")
+
+    logger.info(f"Following Plex notifications ({source.name})")
+    return source.start_alerts(tracker.handle, log_error)
+
+
+def run_alerts():
+    """
+    Follows the notification stream of every Plex server and sends a digest
+    for every debounce window's worth of new media. A dropped stream is
+    reopened within a minute, after announcing what was added while it was
+    down. Never returns.
+    """
+    debounce = parse_period(alert_options["debounce"]).total_seconds()
+    flush = functools.partial(process_events, period=alert_options["debounce"], mode="alert")
+    buffer = EventBuffer(debounce, flush)
+    plex_jobs = {}
+    for job in configured_jobs:
+        if job.source.platform == "plex":
+            plex_jobs.setdefault(job.source, []).append(job)
+    if not plex_jobs:
+        logger.error("plex_alerts is enabled, but no job uses a Plex server")
+        return
+
+    threads = {}
+    started = False
+    while True:
+        for source, jobs in plex_jobs.items():
+            thread = threads.get(source)
+            if thread is not None and thread.is_alive():
+                continue
+            if started:
+                logger.warning(f"Plex notification stream closed ({source.name}), reconnecting")
+                run_update(jobs, until=datetime.now())
+            try:
+                threads[source] = start_alerts(source, jobs, buffer)
+            except Exception as e:
+                logger.error(f"Following Plex notifications failed ({source.name}): {str(e)}")
+        started = True
+        time.sleep(60)
+
+def parse_args():
+    """Parses the command line. Without a command the app runs as configured."""
+    parser = argparse.ArgumentParser(description="Announces recently added media to Discord")
+    commands = parser.add_subparsers(dest="command")
+    backfill = commands.add_parser(
+        "backfill", help="announce the media added in a past period, one digest per window")
+    backfill.add_argument("--from", dest="start", required=True, type=datetime.fromisoformat,
+                          help='start of the period in local time, e.g. 2024-05-01 or "2024-05-01 12:00"')
+    backfill.add_argument("--to", dest="end", type=datetime.fromisoformat,
+                          help="end of the period (default: now)")
+    backfill.add_argument("--window", default="1d",
+                          help="period covered by each digest, like lookback_period (default: 1d)")
+    backfill.add_argument("--job", dest="jobs", action="append",
+                          help="only backfill this job; can be given more than once")
+    rollup = commands.add_parser(
+        "rollup", help="send a daily, weekly or monthly rollup now, built from the history")
+    rollup.add_argument("kind", choices=list(rollup_titles))
+    rollup.add_argument("--date", dest="day", type=datetime.fromisoformat,
+                        help="a day within the period, e.g. 2024-05-01 (default: the last full period)")
+    rollup.add_argument("--job", dest="jobs", action="append",
+                        help="only send it for this job; can be given more than once")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
+    args = parse_args()
     logger.info("Starting")
-    
-    # Schedule the job based on lookback period
-    unit = lookback_period[-1]
-    value = int(lookback_period[:-1])
-    
-    if unit == 'm':
-        schedule.every(value).minutes.do(run_update)
-        logger.info(f"Schedule: every {value} minutes")
-    elif unit == 'h':
-        schedule.every(value).hours.do(run_update)
-        logger.info(f"Schedule: every {value} hours")
-    elif unit == 'd':
-        schedule.every(value).days.do(run_update)
-        logger.info(f"Schedule: every {value} days")
-    elif unit == 'w':
-        schedule.every(value).weeks.do(run_update)
-        logger.info(f"Schedule: every {value} weeks")
-    
-    # Run initial update
-    run_update()
-    
-    # Keep main thread alive and handle the scheduler
+
+    if args.command == "backfill":
+        # Messages that could not be sent stay in the outbox for the next run
+        sys.exit(0 if run_backfill(args.start, args.end or datetime.now(), args.window, args.jobs) else 1)
+    if args.command == "rollup":
+        run_rollup(args.kind, args.day, args.jobs)
+        sys.exit(0)
+
+    if metrics_options["enabled"]:
+        start_metrics_server(metrics_options["host"], metrics_options["port"], metrics)
+        logger.info(f"Serving metrics on port {metrics_options['port']}")
+
+    if listener_options["enabled"] or alert_options["enabled"]:
+        # Announce anything added while we were not running, then wait
+        # for the media server to report new media
+        threading.Thread(target=run_outbox, daemon=True).start()
+        run_update(until=datetime.now())
+        if any(job.rollups for job in configured_jobs):
+            settle = max(parse_period(options["debounce"]).total_seconds()
+                         for options in (listener_options, alert_options) if options["enabled"])
+            threading.Thread(target=run_rollups, args=(settle,), daemon=True).start()
+        try:
+            if listener_options["enabled"] and alert_options["enabled"]:
+                threading.Thread(target=run_alerts, daemon=True).start()
+                run_listener()
+            elif listener_options["enabled"]:
+                run_listener()
+            else:
+                run_alerts()
+        except KeyboardInterrupt:
+            logger.info("Stopping")
+        sys.exit(0)
+
+    for period in dict.fromkeys(job.lookback_period for job in configured_jobs):
+        logger.info(f"Schedule: every {describe_period(period)}")
+
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        if engine == "async":
+            asyncio.run(run_async())
+        else:
+            threading.Thread(target=run_outbox, daemon=True).start()
+            run_scheduler()
     except KeyboardInterrupt:
         logger.info("Stopping")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Run instrumentation: phase timings, HTTP request counts and bytes.
+
+Counters, gauges and timings are kept in memory with their labels. They
+can be served in the Prometheus text format on /metrics, and the change
+over a single run can be summarised as a JSON run report.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Prepended to every metric name
+PREFIX = "recentlyadded_"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (type, name) -> {labels: value}, where labels is a sorted tuple of
+        # (name, value) pairs and the value of a summary is [count, sum]
+        self.values = {}
+
+    def _series(self, kind, name, labels):
+        return self.values.setdefault((kind, name), {}), tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        with self.lock:
+            series, key = self._series("counter", name, labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge"""
+        with self.lock:
+            series, key = self._series("gauge", name, labels)
+            series[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """Record a duration"""
+        with self.lock:
+            series, key = self._series("summary", name, labels)
+            count, total = series.get(key, (0, 0.0))
+            series[key] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record how long the with block takes"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """Copy of the current values, to pass to report() later"""
+        with self.lock:
+            return {metric: dict(series) for metric, series in self.values.items()}
+
+    def report(self, snapshot):
+        """
+        Returns what changed since the snapshot as a dict for a JSON run
+        report: counters and durations by how much they grew, gauges by
+        their current value.
+        """
+        report = {"counters": [], "durations": [], "gauges": []}
+        with self.lock:
+            for (kind, name), series in sorted(self.values.items()):
+                before = snapshot.get((kind, name), {})
+                for key, value in sorted(series.items()):
+                    entry = {"name": name, "labels": dict(key)}
+                    if kind == "counter":
+                        entry["value"] = value - before.get(key, 0)
+                        if entry["value"]:
+                            report["counters"].append(entry)
+                    elif kind == "summary":
+                        count, total = before.get(key, (0, 0.0))
+                        entry["count"] = value[0] - count
+                        entry["seconds"] = round(value[1] - total, 6)
+                        if entry["count"]:
+                            report["durations"].append(entry)
+                    else:
+                        entry["value"] = value
+                        report["gauges"].append(entry)
+        return report
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for (kind, name), series in sorted(self.values.items()):
+                metric = PREFIX + name
+                lines.append(f"# TYPE {metric} {kind}")
+                for key, value in sorted(series.items()):
+                    labels = format_labels(key)
+                    if kind == "summary":
+                        lines.append(f"{metric}_count{labels} {value[0]}")
+                        lines.append(f"{metric}_sum{labels} {value[1]}")
+                    else:
+                        lines.append(f"{metric}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(key):
+    """Format a labels tuple as {name="value",...}"""
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+               for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+class TimedIterator:
+    """
+    Wraps an iterator and adds up the time spent waiting for its items, so
+    a lazily fetched query can be timed apart from the code consuming it.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+class TimedAsyncIterator:
+    """TimedIterator for an async iterator, such as an async generator"""
+
+    def __init__(self, iterable):
+        self.iterator = iterable.__aiter__()
+        self.seconds = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            return await self.iterator.__anext__()
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+def instrument_session(session, metrics):
+    """
+    Counts every request made through a requests.Session, and the bytes
+    sent and received, by host.
+    """
+    def count_response(response, *args, **kwargs):
+        host = urlsplit(response.url).netloc
+        body = response.request.body
+        metrics.inc("http_requests_total", host=host, status=str(response.status_code))
+        metrics.inc("http_request_bytes_total", len(body) if body else 0, host=host)
+        metrics.inc("http_response_bytes_total", len(response.content), host=host)
+
+    session.hooks["response"].append(count_response)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Set on the subclass created by start_metrics_server
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_metrics_server(host, port, metrics):
+    """
+    Serves the metrics on http://<host>:<port>/metrics from a background
+    thread. Returns the server.
+    """
+    handler = type("Handler", (MetricsHandler,), {"metrics": metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Durable outbox for webhook messages.
+
+Every message is written to the outbox, stored as a small JSON file, before
+it is sent, and only removed once Discord has accepted it. A message that
+could not be delivered stays in the outbox and is retried with exponential
+backoff, in order per webhook, so an outage of Discord or the network
+delays announcements instead of losing them.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from storage import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(self, path, backoff=30, max_backoff=3600, max_age=7 * 86400):
+        """
+        Arguments:
+        path -- JSON file the outbox is kept in
+        backoff -- seconds to wait before the first retry; doubled per attempt
+        max_backoff -- longest wait between two retries, in seconds
+        max_age -- seconds after which an undelivered message is dropped
+        """
+        self.path = Path(path)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Held while delivering, so a message is never sent twice at once.
+        # The async path has its own lock, created on the event loop that
+        # delivers, so waiting for it does not block the loop.
+        self.deliver_lock = threading.Lock()
+        self.async_deliver_lock = None
+        self.entries = self._load()
+        self.next_id = max((entry["id"] for entry in self.entries), default=0) + 1
+
+    def _load(self):
+        """Read the outbox file, starting empty if it is missing or unreadable"""
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file).get("entries", [])
+        except (OSError, ValueError):
+            return []
+
+    def save(self):
+        """Atomically write the outbox file"""
+        def snapshot():
+            with self.lock:
+                return {"entries": [dict(entry) for entry in self.entries]}
+
+        atomic_write_json(self.path, snapshot)
+
+    def add(self, job, url, content, embeds):
+        """
+        Queue a message and save the outbox. If the outbox cannot be saved
+        the message stays queued, and is saved with the next change.
+
+        Arguments:
+        job -- name of the job the message belongs to
+        url -- the webhook URL
+        content -- message text
+        embeds -- list of embed dicts
+        """
+        now = time.time()
+        with self.lock:
+            self.entries.append({
+                "id": self.next_id,
+                "job": job,
+                "url": url,
+                "content": content,
+                "embeds": embeds,
+                "created": now,
+                "attempts": 0,
+                "next_attempt": now
+            })
+            self.next_id += 1
+        try:
+            self.save()
+        except OSError as err:
+            logger.error(f"Saving outbox failed, keeping the message in memory: {str(err)}")
+
+    def pending(self):
+        """Number of messages waiting to be delivered"""
+        with self.lock:
+            return len(self.entries)
+
+    def next_due(self):
+        """Time (as epoch seconds) the next retry is due, or None if empty"""
+        with self.lock:
+            return min((entry["next_attempt"] for entry in self.entries), default=None)
+
+    def _remove(self, entry):
+        with self.lock:
+            self.entries.remove(entry)
+
+    def due(self):
+        """
+        Returns the messages to send now as a dict mapping each webhook URL
+        to its messages, oldest first. Once a message to a webhook is not
+        due yet, later messages to the same webhook wait for it, so they
+        arrive in order. Messages older than max_age are dropped.
+        """
+        with self.lock:
+            entries = list(self.entries)
+        now = time.time()
+        due = {}
+        blocked = set()
+        for entry in entries:
+            if entry["url"] in blocked:
+                continue
+            if now - entry["created"] > self.max_age:
+                logger.error(f"Dropping webhook message for {entry['job']} after {entry['attempts']} attempts")
+                self._remove(entry)
+            elif entry["next_attempt"] > now:
+                blocked.add(entry["url"])
+            else:
+                due.setdefault(entry["url"], []).append(entry)
+        return due
+
+    def delivered(self, entry):
+        """Remove a message Discord has accepted"""
+        self._remove(entry)
+
+    def failed(self, entry, err):
+        """
+        Schedule the retry of a message that could not be sent. Messages
+        rejected by Discord (4xx errors other than rate limits, which the
+        dispatcher handles) are dropped instead.
+        """
+        status = getattr(getattr(err, "response", None), "status_code", None)
+        if status is None:
+            status = getattr(err, "status", None)
+        if status is not None and 400 <= status < 500:
+            logger.error(f"Webhook for {entry['job']} rejected the message ({status}), dropping it")
+            self._remove(entry)
+            return
+        entry["attempts"] += 1
+        delay = min(self.backoff * 2 ** (entry["attempts"] - 1), self.max_backoff)
+        entry["next_attempt"] = time.time() + delay
+        logger.warning(f"Webhook failed for {entry['job']}, retrying in {delay:.0f}s: {str(err)}")
+
+    def deliver(self, send):
+        """
+        Sends every message that is due (see due()). After a failure the
+        remaining messages to that webhook wait for the retry. Returns the
+        number of messages delivered.
+
+        Arguments:
+        send -- function that sends an entry and raises if it failed
+        """
+        with self.deliver_lock:
+            delivered = 0
+            for entries in self.due().values():
+                for entry in entries:
+                    try:
+                        send(entry)
+                    except Exception as err:
+                        self.failed(entry, err)
+                        break
+                    self.delivered(entry)
+                    delivered += 1
+            self.save()
+            return delivered
+
+    async def deliver_async(self, send):
+        """
+        Like deliver(), but send is a coroutine function and the messages
+        to different webhooks are sent concurrently. Concurrent calls on the
+        same event loop wait for each other. A process delivers either
+        with deliver() or with deliver_async(), not both.
+        """
+        async def deliver_webhook(entries):
+            delivered = 0
+            for entry in entries:
+                try:
+                    await send(entry)
+                except Exception as err:
+                    self.failed(entry, err)
+                    break
+                self.delivered(entry)
+                delivered += 1
+            return delivered
+
+        if self.async_deliver_lock is None:
+            self.async_deliver_lock = asyncio.Lock()
+        async with self.async_deliver_lock:
+            delivered = await asyncio.gather(*(deliver_webhook(entries)
+                                               for entries in self.due().values()))
+            self.save()
+            return sum(delivered)
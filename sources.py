@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+"""
+Media servers that recently added media is read from.
+
+Every backend implements MediaSource and yields normalized RecentItem
+records, so counting, formatting and sending are shared by all of them.
+Supporting another server (e.g. Emby) means adding a MediaSource subclass
+and registering it in SOURCES.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from plexapi.exceptions import NotFound
+from plexapi.server import PlexServer
+from listener import parse_jellyfin_webhook, parse_plex_webhook
+
+# Number of items requested per batched metadata lookup. Keeps the
+# comma-separated key list well below common URL length limits.
+metadata_batch_size = 100
+
+# Number of items requested per page when listing a library's new media
+page_size = 200
+
+# Seconds a library that was not found is remembered as missing before the
+# server's libraries are listed again for it
+missing_library_ttl = 600
+
+# Kinds of external IDs that identify the same title across libraries
+external_id_schemes = ("imdb", "tmdb", "tvdb")
+
+# Plex metadata type numbers used to filter library listings
+plex_types = {
+    "movie": 1,
+    "show": 2,
+    "episode": 4
+}
+
+
+def cast_int(value):
+    """Convert an XML/JSON attribute to int, passing None through"""
+    return int(value) if value is not None else None
+
+
+def parse_jellyfin_date(value):
+    """
+    Convert a Jellyfin timestamp (e.g. "2024-01-02T03:04:05.1234567Z") to
+    epoch seconds. Fractional seconds are dropped, as Jellyfin sends seven
+    digits which strptime cannot parse.
+    """
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+class RecentItem:
+    """
+    A newly added movie or episode, normalized across backends. Episodes
+    also carry the ID and title of their show and their season and episode
+    numbers. Movies carry their external IDs as "<scheme>://<id>" strings
+    (e.g. "imdb://tt1160419"), which are the same in every library.
+    """
+    __slots__ = ("item_id", "title", "year", "added_at", "show_id",
+                 "show_title", "season", "episode", "guids")
+
+    def __init__(self, item_id, title, year=None, added_at=None, show_id=None,
+                 show_title=None, season=None, episode=None, guids=()):
+        self.item_id = item_id
+        self.title = title
+        self.year = year
+        self.added_at = added_at
+        self.show_id = show_id
+        self.show_title = show_title
+        self.season = season
+        self.episode = episode
+        self.guids = guids
+
+
+class LibraryRegistry:
+    """
+    Resolves the libraries named in config.yml to the server's keys (Plex
+    section keys, Jellyfin library IDs) and media types. The server's
+    libraries are listed once and kept while the app runs. Looking up a
+    library that is not known lists them again, in case it was added or
+    renamed since; if it is still not found, that is remembered for
+    missing_library_ttl seconds, so it is not listed again on every
+    lookup. invalidate() forgets both, e.g. once a key has stopped
+    working.
+
+    Arguments:
+    load -- function returning a (name, key, media_type) tuple for every
+            library of the server, where media_type is "movie", "episode"
+            or None if the library holds other media
+    """
+
+    def __init__(self, load):
+        self.load = load
+        # Lowercased name or key -> (key, media_type)
+        self.libraries = None
+        # Lowercased name or key not found after listing the libraries ->
+        # time.monotonic() it was found missing
+        self.missing = {}
+        self.lock = threading.Lock()
+        # Held while listing the libraries, so it is done once at a time
+        self.load_lock = threading.Lock()
+
+    def get(self, library):
+        """Return the cached (key, media_type) of a library by name or key, or None"""
+        with self.lock:
+            if self.libraries is None:
+                return None
+            return self.libraries.get(str(library).lower().strip())
+
+    def is_missing(self, library):
+        """
+        True if the library was not found when the libraries were listed,
+        less than missing_library_ttl seconds ago
+        """
+        with self.lock:
+            missed_at = self.missing.get(str(library).lower().strip())
+        return missed_at is not None and time.monotonic() - missed_at < missing_library_ttl
+
+    def mark_missing(self, library):
+        """Remember that the library was not found, for missing_library_ttl seconds or until invalidate()"""
+        with self.lock:
+            self.missing[str(library).lower().strip()] = time.monotonic()
+
+    def update(self, entries):
+        """Replace the cached libraries with a list of (name, key, media_type) tuples"""
+        libraries = {}
+        for name, key, media_type in entries:
+            libraries[str(key).lower()] = (key, media_type)
+        for name, key, media_type in entries:
+            libraries[name.lower().strip()] = (key, media_type)
+        with self.lock:
+            self.libraries = libraries
+            self.missing = {}
+
+    def resolve(self, library):
+        """
+        Like get(), but lists the server's libraries if it is not cached
+        and not already known to be missing
+        """
+        entry = self.get(library)
+        if entry is not None or self.is_missing(library):
+            return entry
+        with self.load_lock:
+            # Another thread may have listed them in the meantime
+            entry = self.get(library)
+            if entry is None and not self.is_missing(library):
+                self.update(self.load())
+                entry = self.get(library)
+                if entry is None:
+                    self.mark_missing(library)
+        return entry
+
+    def invalidate(self):
+        with self.lock:
+            self.libraries = None
+            self.missing = {}
+
+
+class MediaSource:
+    """
+    Base class for a media server backend. Subclasses set platform and
+    webhook_parser and implement the methods below. Every source has a
+    name, the key of its server in config.yml.
+    """
+    platform = None
+    # Function from listener.py that reads this backend's webhooks
+    webhook_parser = None
+    name = None
+
+    @classmethod
+    def from_config(cls, name, server_config, session, http_options):
+        """Create the source from its server's settings in config.yml"""
+        raise NotImplementedError
+
+    def connect(self):
+        """Connect to the server. Called at the start of every run."""
+
+    def library(self, library):
+        """
+        Return the (key, media_type) of a library given by name or key,
+        see LibraryRegistry. media_type is None if the server does not say.
+        """
+        raise NotImplementedError
+
+    def recent_items(self, library, media_type, since, until=None):
+        """
+        Yield RecentItem records for media of the given type ("movie" or
+        "episode") added to a library after since (a datetime), newest first.
+        If until is given, only media added before it is needed; backends
+        that cannot filter on it server-side may list it in any order.
+        """
+        raise NotImplementedError
+
+    def event_items(self, library, media_type, events):
+        """
+        Return RecentItem records for the media reported by webhook events
+        that is of the given type and belongs to the library.
+        """
+        raise NotImplementedError
+
+    def show_titles(self, episodes):
+        """
+        Look up the shows of a list of episode records. Returns a dict
+        mapping show_id to a (title, year) tuple; shows that could not be
+        found are left out.
+        """
+        raise NotImplementedError
+
+
+class PlexSource(MediaSource):
+    platform = "plex"
+    webhook_parser = staticmethod(parse_plex_webhook)
+
+    # Media types of the section types the digest supports
+    section_media_types = {
+        "movie": "movie",
+        "show": "episode"
+    }
+
+    def __init__(self, name, url, token, session, timeout):
+        self.name = name
+        self.url = url
+        self.token = token
+        self.session = session
+        self.timeout = timeout
+        self.server = None
+        self.libraries = LibraryRegistry(self.list_libraries)
+
+    @classmethod
+    def from_config(cls, name, server_config, session, http_options):
+        return cls(name, server_config["url"], server_config["token"], session,
+                   http_options["read_timeout"])
+
+    def connect(self):
+        self.server = PlexServer(self.url, self.token, session=self.session,
+                                 timeout=self.timeout)
+
+    @classmethod
+    def library_entries(cls, container):
+        """(name, key, media_type) tuples of a /library/sections response"""
+        return [(element.attrib["title"], element.attrib["key"],
+                 cls.section_media_types.get(element.attrib.get("type")))
+                for element in container]
+
+    def list_libraries(self):
+        return self.library_entries(self.server.query("/library/sections"))
+
+    def library(self, library):
+        entry = self.libraries.resolve(library)
+        if entry is None:
+            raise Exception(f"Invalid library section: {library}")
+        return entry
+
+    @staticmethod
+    def _guids(guid, guid_ids):
+        """
+        External IDs of an item from its Guid children (only sent with
+        includeGuids=1), plus Plex's own GUID, which the same title shares
+        across libraries.
+        """
+        guids = tuple(guid_id for guid_id in guid_ids
+                      if guid_id.split("://")[0] in external_id_schemes)
+        if guid and guid.startswith("plex://"):
+            guids += (guid,)
+        return guids
+
+    @classmethod
+    def _element_item(cls, element):
+        """Build a RecentItem from an XML element"""
+        return cls._item(element.attrib, cls._guids(
+            element.attrib.get("guid"), [guid.attrib["id"] for guid in element.findall("Guid")]))
+
+    @staticmethod
+    def _item(attrib, guids=()):
+        """
+        Build a RecentItem from an XML element's attributes or a webhook's
+        Metadata, reading only what the digest uses rather than building a
+        full plexapi object.
+        """
+        return RecentItem(
+            item_id=int(attrib["ratingKey"]),
+            title=attrib.get("title", "Unknown"),
+            year=cast_int(attrib.get("year")),
+            added_at=cast_int(attrib.get("addedAt")),
+            show_id=cast_int(attrib.get("grandparentRatingKey")),
+            show_title=attrib.get("grandparentTitle"),
+            season=cast_int(attrib.get("parentIndex")),
+            episode=cast_int(attrib.get("index")),
+            guids=guids)
+
+    @staticmethod
+    def recent_query(section_key, media_type, since, until=None):
+        """
+        Returns the key and first page's params of the query listing a
+        section's media added after since (and before until, if given),
+        newest first.
+        """
+        # Built by hand because the ">>" and "<<" operators must not be
+        # URL-encoded
+        key = (f"/library/sections/{section_key}/all"
+               f"?type={plex_types[media_type]}"
+               f"&addedAt>>={int(since.timestamp())}")
+        if until is not None:
+            key += f"&addedAt<<={int(until.timestamp())}"
+        key += "&sort=addedAt:desc"
+        params = {
+            # Skip the parts of each item the digest never reads. Movies
+            # keep their external IDs, to list copies in several libraries once.
+            'includeGuids': int(media_type == "movie"),
+            'excludeFields': 'summary',
+            'X-Plex-Container-Start': 0,
+            'X-Plex-Container-Size': page_size
+        }
+        return key, params
+
+    def recent_items(self, library, media_type, since, until=None):
+        """
+        Queries /library/sections/<id>/all directly, one page at a time, so
+        plexapi never builds full objects for the results.
+        """
+        section_key, _ = self.library(library)
+        key, params = self.recent_query(section_key, media_type, since, until)
+        while True:
+            try:
+                container = self.server.query(key, params=params)
+            except NotFound:
+                # The section was removed, or recreated under a new key
+                self.libraries.invalidate()
+                raise
+            elements = list(container) if container is not None else []
+            for element in elements:
+                yield self._element_item(element)
+
+            if len(elements) < page_size:
+                return
+            params['X-Plex-Container-Start'] += page_size
+
+    def event_items(self, library, media_type, events):
+        # A webhook names the library and carries the item's metadata. An
+        # alert (see listener.PlexAlertTracker) only has the section and
+        # item IDs, so those items are fetched.
+        items = [self._item(metadata, self._guids(metadata.get("guid"),
+                                                  [guid["id"] for guid in metadata.get("Guid", [])]))
+                 for metadata in events
+                 if "ratingKey" in metadata
+                 and metadata.get("librarySectionTitle") == library
+                 and metadata.get("type") == media_type]
+        alerts = [alert for alert in events
+                  if "itemID" in alert and alert["type"] == plex_types[media_type]]
+        if alerts:
+            section_id = str(self.library(library)[0])
+            items.extend(self.metadata_items(
+                [alert["itemID"] for alert in alerts if alert["sectionID"] == section_id], True))
+        return items
+
+    def metadata_items(self, rating_keys, include_guids=False):
+        """
+        Yields a RecentItem for every rating key, fetched in batched
+        /library/metadata/<k1>,<k2>,... requests. Items that no longer
+        exist are left out.
+        """
+        params = {'includeGuids': int(include_guids)}
+        for i in range(0, len(rating_keys), metadata_batch_size):
+            batch = ",".join(str(key) for key in rating_keys[i:i + metadata_batch_size])
+            for element in self.server.query(f"/library/metadata/{batch}", params=params):
+                yield self._element_item(element)
+
+    def show_titles(self, episodes):
+        """Every distinct show is fetched once, see metadata_items"""
+        # dict.fromkeys keeps the first-seen order while dropping duplicates
+        show_ids = list(dict.fromkeys(
+            episode.show_id for episode in episodes if episode.show_id is not None))
+        return {show.item_id: (show.title, show.year) for show in self.metadata_items(show_ids)}
+
+    def start_alerts(self, callback, error_callback):
+        """
+        Follows the server's notification stream on a background thread,
+        passing every notification to callback. Returns the thread.
+        """
+        return self.server.startAlertListener(callback, error_callback)
+
+
+class JellyfinClient:
+    def __init__(self, url, api_key, session):
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.session = session
+        self.headers = {
+            'X-Emby-Token': api_key,
+            'Content-Type': 'application/json'
+        }
+
+    def get_libraries(self):
+        """Get all libraries ("virtual folders") from Jellyfin"""
+        response = self.session.get(f"{self.url}/Library/VirtualFolders", headers=self.headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"Failed to get libraries: {response.status_code}")
+
+    @staticmethod
+    def library_items_params(library_id, item_type=None, date_added_after=None, item_ids=None,
+                             oldest_first=False):
+        """
+        Returns the params of the first page of a get_library_items query.
+        Only the fields used for the digest are requested, without images
+        or user data.
+        """
+        params = {
+            'ParentId': library_id,
+            'IncludeItemTypes': item_type,
+            'Recursive': True,
+            'SortBy': 'DateCreated',
+            'SortOrder': 'Ascending' if oldest_first else 'Descending',
+            'Fields': 'DateCreated,ProviderIds',
+            'EnableImages': False,
+            'EnableUserData': False,
+            'EnableTotalRecordCount': False,
+            'StartIndex': 0,
+            'Limit': page_size
+        }
+
+        if item_ids:
+            params['Ids'] = ",".join(item_ids)
+
+        if date_added_after:
+            # Anything created after the threshold was also saved after it,
+            # so this lets the server discard most of the library up front
+            params['MinDateLastSaved'] = date_added_after.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return params
+
+    def get_library_items(self, library_id, item_type=None, date_added_after=None, item_ids=None,
+                          date_added_before=None):
+        """
+        Yield items from a specific library, newest first, fetched one page
+        at a time. Stops at the first item created at or before
+        date_added_after (a timezone-aware datetime). If item_ids is given,
+        only those items are returned.
+
+        If date_added_before is given, items are listed oldest first
+        instead, since Jellyfin cannot filter on it: items created up to
+        date_added_after are skipped and listing stops at the first item
+        created at or after date_added_before.
+        """
+        oldest_first = date_added_before is not None
+        params = self.library_items_params(library_id, item_type, date_added_after, item_ids, oldest_first)
+        if date_added_after:
+            date_added_after = date_added_after.timestamp()
+        if oldest_first:
+            date_added_before = date_added_before.timestamp()
+
+        while True:
+            response = self.session.get(f"{self.url}/Users/Items", headers=self.headers, params=params)
+            if response.status_code != 200:
+                raise Exception(f"Failed to get library items: {response.status_code}")
+
+            items = response.json().get('Items', [])
+            for item in items:
+                created = parse_jellyfin_date(item['DateCreated'])
+                if oldest_first:
+                    if created >= date_added_before:
+                        return
+                    if date_added_after and created <= date_added_after:
+                        continue
+                elif date_added_after and created <= date_added_after:
+                    return
+                yield item
+
+            if len(items) < page_size:
+                return
+            params['StartIndex'] += page_size
+
+    def get_item(self, item_id):
+        """Get a specific item by ID"""
+        response = self.session.get(f"{self.url}/Users/Items/{item_id}", headers=self.headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"Failed to get item: {response.status_code}")
+
+    def get_items(self, item_ids):
+        """Get several items by ID, in batches of one /Items?Ids= request each"""
+        items = []
+        for i in range(0, len(item_ids), metadata_batch_size):
+            params = {
+                'Ids': ",".join(item_ids[i:i + metadata_batch_size]),
+                'EnableImages': False,
+                'EnableUserData': False
+            }
+            response = self.session.get(f"{self.url}/Items", headers=self.headers, params=params)
+            if response.status_code == 200:
+                items.extend(response.json().get('Items', []))
+            else:
+                raise Exception(f"Failed to get items: {response.status_code}")
+        return items
+
+
+class JellyfinSource(MediaSource):
+    platform = "jellyfin"
+    webhook_parser = staticmethod(parse_jellyfin_webhook)
+
+    # Jellyfin's names for the media types
+    item_types = {
+        "movie": "Movie",
+        "episode": "Episode"
+    }
+
+    # Media types of the collection types the digest supports
+    collection_media_types = {
+        "movies": "movie",
+        "tvshows": "episode"
+    }
+
+    def __init__(self, name, url, api_key, session):
+        self.name = name
+        self.client = JellyfinClient(url, api_key, session)
+        self.libraries = LibraryRegistry(self.list_libraries)
+
+    @classmethod
+    def from_config(cls, name, server_config, session, http_options):
+        return cls(name, server_config["url"], server_config["api_key"], session)
+
+    @classmethod
+    def library_entries(cls, folders):
+        """(name, key, media_type) tuples of a /Library/VirtualFolders response"""
+        return [(folder.get("Name", ""), folder["ItemId"],
+                 cls.collection_media_types.get(folder.get("CollectionType")))
+                for folder in folders]
+
+    def list_libraries(self):
+        return self.library_entries(self.client.get_libraries())
+
+    def library(self, library):
+        # Libraries may be given by name or by ID. An ID that is not one of
+        # the server's libraries (e.g. a folder within one) is used as is.
+        return self.libraries.resolve(library) or (library, None)
+
+    @staticmethod
+    def _item(item):
+        """Build a RecentItem from a Jellyfin item"""
+        return RecentItem(
+            item_id=item['Id'],
+            title=item.get('Name', 'Unknown'),
+            year=item.get('ProductionYear'),
+            added_at=parse_jellyfin_date(item['DateCreated']),
+            show_id=item.get('SeriesId'),
+            show_title=item.get('SeriesName'),
+            season=item.get('ParentIndexNumber'),
+            episode=item.get('IndexNumber'),
+            guids=tuple(f"{scheme.lower()}://{value}"
+                        for scheme, value in (item.get('ProviderIds') or {}).items()
+                        if scheme.lower() in external_id_schemes and value))
+
+    def recent_items(self, library, media_type, since, until=None):
+        # Jellyfin dates are UTC; items are checked against the full
+        # timestamp so a lookback of a few hours does not pull the whole day
+        library_id, _ = self.library(library)
+        for item in self.client.get_library_items(
+                library_id, self.item_types[media_type], since.astimezone(timezone.utc),
+                date_added_before=until.astimezone(timezone.utc) if until else None):
+            yield self._item(item)
+
+    def event_items(self, library, media_type, events):
+        # Jellyfin does not name the library in the event, so the reported
+        # IDs are looked up in the library, metadata_batch_size per
+        # request, which also returns the fields we need
+        item_type = self.item_types[media_type]
+        item_ids = list(dict.fromkeys(event["ItemId"] for event in events
+                                      if event.get("ItemType") == item_type and event.get("ItemId")))
+        if not item_ids:
+            return []
+        library_id, _ = self.library(library)
+        items = []
+        for i in range(0, len(item_ids), metadata_batch_size):
+            items.extend(self._item(item) for item in self.client.get_library_items(
+                library_id, item_type, item_ids=item_ids[i:i + metadata_batch_size]))
+        return items
+
+    def show_titles(self, episodes):
+        """Each distinct SeriesId is fetched once, and the lookups are batched."""
+        series_ids = list(dict.fromkeys(
+            episode.show_id for episode in episodes if episode.show_id))
+        return {series['Id']: (series.get('Name', 'Unknown'), series.get('ProductionYear'))
+                for series in self.client.get_items(series_ids)}
+
+
+# Backends by the name used for "platform" in config.yml
+SOURCES = {
+    "plex": PlexSource,
+    "jellyfin": JellyfinSource
+}
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent run state, stored as a small JSON file.
+
+For every library the store keeps a high-water mark: the newest added time
+(as epoch seconds) that has been announced. Along with it, it keeps the IDs
+announced at or after that time. Each run only has to query media added
+since the mark. Items that sit exactly on the boundary, or that a retried
+or overlapping run sees again, are recognised by ID and not reposted.
+
+For every scheduled job it also keeps the end of the last window that was
+announced, so a restart carries on from there instead of from "now".
+"""
+import json
+import threading
+from pathlib import Path
+from storage import atomic_write_json
+
+
+class StateStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.libraries, self.windows = self._load()
+
+    def _load(self):
+        """Read the state file, starting empty if it is missing or unreadable"""
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+            return data.get("libraries", {}), data.get("windows", {})
+        except (OSError, ValueError):
+            return {}, {}
+
+    def get_watermark(self, key):
+        """Return the newest announced added time for a library, or None"""
+        with self.lock:
+            return self.libraries.get(key, {}).get("watermark")
+
+    def is_announced(self, key, item_id):
+        """Return True if the item has already been sent for this library"""
+        with self.lock:
+            return str(item_id) in self.libraries.get(key, {}).get("announced", {})
+
+    def advance(self, key, items):
+        """
+        Record items as announced and move the library's watermark forward.
+        IDs older than the new watermark are dropped, since later queries
+        will not return them again.
+
+        Arguments:
+        key -- string identifying the library
+        items -- iterable of (item_id, added_at) tuples, added_at in epoch seconds
+        """
+        with self.lock:
+            library = self.libraries.setdefault(key, {"watermark": None, "announced": {}})
+            announced = library["announced"]
+            for item_id, added_at in items:
+                announced[str(item_id)] = added_at
+            if not announced:
+                return
+            watermark = max(announced.values())
+            if library["watermark"] is not None:
+                watermark = max(watermark, library["watermark"])
+            library["watermark"] = watermark
+            library["announced"] = {item_id: added_at
+                                    for item_id, added_at in announced.items()
+                                    if added_at >= watermark}
+
+    def get_window(self, key):
+        """Return the end (as epoch seconds) of the job's last announced window, or None"""
+        with self.lock:
+            return self.windows.get(key)
+
+    def set_window(self, key, end):
+        """Record the end (as epoch seconds) of the job's last announced window"""
+        with self.lock:
+            self.windows[key] = end
+
+    def save(self):
+        """Atomically write the state file"""
+        def snapshot():
+            with self.lock:
+                return {"libraries": {key: dict(library, announced=dict(library["announced"]))
+                                      for key, library in self.libraries.items()},
+                        "windows": dict(self.windows)}
+
+        atomic_write_json(self.path, snapshot, indent=2)
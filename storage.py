@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Atomic writes of the JSON files kept in data_dir.
+
+Each file is written to a temporary file next to it, which then replaces
+it, so a crash mid-write never leaves a truncated file behind. Writes of
+the same file are serialized, so concurrent saves from different threads
+neither share the temporary file nor let an older snapshot overwrite a
+newer one.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+# Absolute path -> lock held while that file is written
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def atomic_write_json(path, data, **dump_options):
+    """
+    Atomically writes data to path as JSON.
+
+    Arguments:
+    path -- the file to write; its directory is created if needed
+    data -- the data to write, or a function returning it, which is called
+            while the file is locked so the newest snapshot is written last
+    dump_options -- passed on to json.dump, e.g. indent=2
+    """
+    path = Path(path)
+    with _locks_lock:
+        lock = _locks.setdefault(path.resolve(), threading.Lock())
+    with lock:
+        if callable(data):
+            data = data()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, **dump_options)
+        os.replace(temp_path, path)
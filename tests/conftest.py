@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import importlib
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory, monkeypatch_module):
+    # main.py reads config.yml from its own directory when imported, so it is
+    # imported from a copy with the benchmark's configuration
+    workdir = tmp_path_factory.mktemp("app")
+    for path in ROOT.glob("*.py"):
+        shutil.copy(path, workdir)
+    (workdir / "logs").mkdir()
+    monkeypatch_module.setenv("LOG_DIR", str(workdir / "logs"))
+    monkeypatch_module.syspath_prepend(str(workdir))
+    for name in ("main", "benchmark"):
+        sys.modules.pop(name, None)
+    importlib.import_module("benchmark").write_config(workdir, "plex", "http://127.0.0.1:9")
+    yield importlib.import_module("main")
+    for name in ("main", "benchmark"):
+        sys.modules.pop(name, None)
+
+
+@pytest.fixture(scope="module")
+def monkeypatch_module():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        yield monkeypatch
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+pack_embeds must keep every message within Discord's limits, or Discord
+rejects it and the outbox drops it.
+"""
+import random
+
+import pytest
+
+
+def random_embeds(main, rng):
+    embeds = []
+    for _ in range(rng.randint(1, 15)):
+        title = "x" * rng.randint(5, 256)
+        lines = ["• " + "y" * rng.randint(5, 300) for _ in range(rng.randint(1, 120))]
+        main.create_embeds(title, "\n".join(lines), 0xFB8800, embeds)
+    return embeds
+
+
+def test_messages_stay_within_discord_limits(main):
+    rng = random.Random(1)
+    for _ in range(300):
+        embeds = random_embeds(main, rng)
+        messages = main.pack_embeds(embeds)
+        for message in messages:
+            assert 1 <= len(message) <= 10
+            assert sum(len(embed.title) + len(embed.description) for embed in message) <= 6000
+            assert all(len(embed.description) <= 4096 for embed in message)
+
+        # Every line is still there, in order
+        packed = "\n".join(embed.description for message in messages for embed in message)
+        assert packed == "\n".join(embed.description for embed in embeds)
+
+
+def test_split_on_newline_rejects_negative_length(main):
+    with pytest.raises(ValueError):
+        main.split_on_newline("a\nb", -1)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Rollups list media by the day it was added, however late it was announced,
+and wait for the windows that announce it.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def rollups(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "history", main.History(tmp_path / "history.db"))
+    monkeypatch.setattr(main, "state", main.StateStore(tmp_path / "state.json"))
+    sent = []
+    monkeypatch.setattr(main.outbox, "add", lambda job, url, content, embeds: sent.append(embeds))
+    job = main.configured_jobs[0]
+    monkeypatch.setattr(job, "rollups", ["daily"])
+    return job, sent
+
+
+def announce(main, job, titles, announced_at):
+    batch = main.history.begin(job.name, "Movies", "movies")
+    for item_id, (title, added_at) in enumerate(titles.items()):
+        batch.add("movie", item_id, title, 2024, added_at=added_at.timestamp())
+    batch.commit(announced_at.timestamp())
+
+
+def rollup_titles(main, job, sent, start):
+    sent.clear()
+    main.queue_rollup(job, "daily", start, start + timedelta(days=1))
+    return [line for embeds in sent for embed in embeds for line in embed["description"].splitlines()]
+
+
+def test_rollup_by_day_added(main, rollups):
+    job, sent = rollups
+    midnight = datetime(2024, 5, 9)
+    # Announced together by the window ending at 04:00
+    announce(main, job, {"Late Night": midnight - timedelta(seconds=1),
+                         "Midnight": midnight,
+                         "Morning": midnight + timedelta(hours=3)},
+             midnight + timedelta(hours=4))
+
+    before = rollup_titles(main, job, sent, midnight - timedelta(days=1))
+    after = rollup_titles(main, job, sent, midnight)
+    assert [line for line in before if "Late Night" in line]
+    assert not [line for line in before if "Midnight" in line or "Morning" in line]
+    assert [line for line in after if "Midnight" in line]
+    assert [line for line in after if "Morning" in line]
+    assert not [line for line in after if "Late Night" in line]
+
+
+def test_rollup_waits_for_window(main, rollups):
+    job, sent = rollups
+    midnight = datetime(2024, 5, 9)
+    main.state.set_window(f"{job.name}:rollup:daily", (midnight - timedelta(days=1)).timestamp())
+
+    main.state.set_window(job.name, (midnight - timedelta(hours=4)).timestamp())
+    assert main.due_rollups([job], now=midnight + timedelta(minutes=1)) == []
+
+    main.state.set_window(job.name, midnight.timestamp())
+    assert main.due_rollups([job], now=midnight + timedelta(minutes=1)) == [
+        (job, "daily", midnight - timedelta(days=1), midnight)]
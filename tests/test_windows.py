@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Consecutive windows must announce media added on their boundary exactly
+once.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+class FakeSource:
+    """Returns media added after since, as the servers do"""
+
+    def __init__(self, added):
+        # Imported from the copy main was imported from (see conftest.py)
+        from sources import RecentItem
+        self.items = [RecentItem(str(item_id), f"Movie {item_id}", 2024, added_at.timestamp())
+                      for item_id, added_at in enumerate(added)]
+
+    def recent_items(self, library, media_type, since, until=None):
+        return [item for item in self.items
+                if item.added_at > since.timestamp() and (until is None or item.added_at < until.timestamp())]
+
+
+@pytest.fixture
+def job(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "state", main.StateStore(tmp_path / "state.json"))
+    return main.configured_jobs[0]
+
+
+def test_boundary_in_one_window(main, job, monkeypatch):
+    boundary = datetime(2024, 5, 9, 12)
+    monkeypatch.setattr(job, "source", FakeSource([boundary - timedelta(seconds=1), boundary,
+                                                   boundary + timedelta(seconds=1)]))
+    first = (boundary - timedelta(hours=1), boundary)
+    second = (boundary, boundary + timedelta(hours=1))
+
+    before = [item.item_id for item in main.query_library(job, "movies", "movie", first)]
+    after = [item.item_id for item in main.query_library(job, "movies", "movie", second)]
+    assert before == ["0"]
+    assert after == ["1", "2"]
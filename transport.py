@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP transport for talking to Plex, Jellyfin, Discord and uptime
+monitors.
+
+A single pooled requests.Session keeps connections (and their TLS
+handshakes) alive between calls, applies default connect/read timeouts and
+retries idempotent failures with exponential backoff.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Defaults used when the "http" section of config.yml is missing or partial
+DEFAULT_OPTIONS = {
+    "pool_size": 10,
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "retries": 3,
+    "backoff_factor": 0.5,
+}
+
+# Server-side errors worth retrying. Discord rate limits (429) are left to
+# the caller, which knows how long to wait.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request"""
+
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(options=None):
+    """
+    Creates a pooled, keep-alive requests.Session with default timeouts and
+    retries of idempotent requests with exponential backoff on 5xx
+    responses and connection resets.
+
+    Arguments:
+    options -- dict; optional overrides for any key in DEFAULT_OPTIONS
+    """
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+
+    retry = Retry(
+        total=settings["retries"],
+        connect=settings["retries"],
+        read=settings["retries"],
+        status=settings["retries"],
+        backoff_factor=settings["backoff_factor"],
+        # Only idempotent methods (urllib3's default allowed_methods) are
+        # retried. Discord may already have created a webhook message whose
+        # response was lost, so POSTs are left to the dispatcher and outbox.
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(
+        timeout=(settings["connect_timeout"], settings["read_timeout"]),
+        pool_connections=settings["pool_size"],
+        pool_maxsize=settings["pool_size"],
+        max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session